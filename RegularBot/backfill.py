@@ -0,0 +1,102 @@
+"""
+History backfill for RegularBot.
+
+Seeds message counts from messages sent before the bot joined a guild. Channel
+histories are streamed a page at a time and counted into small chunks, so
+memory stays flat no matter how much history there is. Every chunk is written
+together with the channel's checkpoint, so an interrupted backfill resumes
+where it stopped without counting anything twice.
+"""
+
+import asyncio
+from collections import Counter
+import discord
+from RegularBot.config import GuildPolicy
+from RegularBot.counter_cache import MessageCounterCache
+from RegularBot.storage import RegularBotStorage
+
+# Channels read at the same time
+MAX_CHANNELS_IN_FLIGHT = 4
+# Messages counted in memory before they're written out
+CHUNK_MESSAGES = 5000
+
+class BackfillSummary:
+    __slots__ = ("messages", "channels_done", "channels_skipped")
+
+    def __init__(self):
+        self.messages = 0
+        self.channels_done = 0
+        self.channels_skipped = 0
+
+    def __str__(self):
+        return f"{self.messages} messages counted, {self.channels_done} channels done, {self.channels_skipped} channels skipped"
+
+class HistoryBackfill:
+
+    def __init__(self, storage: RegularBotStorage, counter_cache: MessageCounterCache, max_channels=MAX_CHANNELS_IN_FLIGHT):
+        self.storage = storage
+        self.counter_cache = counter_cache
+        self.max_channels = max_channels
+
+    async def run(self, guild: discord.Guild, policy: GuildPolicy) -> BackfillSummary:
+        # Everything from when the bot joined onwards was already counted live
+        cutoff_id = discord.utils.time_snowflake(guild.me.joined_at)
+        checkpoints = await self.storage.get_checkpoints(guild.id)
+        summary = BackfillSummary()
+        semaphore = asyncio.Semaphore(self.max_channels)
+
+        async def run_channel(channel):
+            async with semaphore:
+                await self._backfill_channel(guild, channel, policy, checkpoints.get(channel.id), cutoff_id, summary)
+
+        channels = [c for c in guild.text_channels if c.id not in policy.ignore_channels]
+        await asyncio.gather(*(run_channel(c) for c in channels))
+        return summary
+
+    async def _backfill_channel(self, guild, channel, policy, checkpoint, cutoff_id, summary):
+        if checkpoint is None:
+            before_id, last_message_id, channel_total, done = cutoff_id, 0, 0, False
+        else:
+            before_id, last_message_id, channel_total, done = checkpoint
+        if done:
+            summary.channels_done += 1
+            return
+
+        if not channel.permissions_for(guild.me).read_message_history:
+            summary.channels_skipped += 1
+            return
+
+        counts = Counter()
+        pending = 0
+        try:
+            history = channel.history(
+                limit=None,
+                after=discord.Object(last_message_id) if last_message_id else None,
+                before=discord.Object(before_id),
+                oldest_first=True,
+            )
+            async for message in history:
+                last_message_id = message.id
+                if message.author.bot or message.author.system:
+                    continue
+                counts[message.author.id] += 1
+                pending += 1
+                if pending >= CHUNK_MESSAGES:
+                    channel_total += pending
+                    await self._write_chunk(guild.id, channel.id, counts, (before_id, last_message_id, channel_total, False))
+                    summary.messages += pending
+                    counts.clear()
+                    pending = 0
+        except discord.Forbidden:
+            summary.channels_skipped += 1
+            return
+
+        channel_total += pending
+        await self._write_chunk(guild.id, channel.id, counts, (before_id, last_message_id, channel_total, True))
+        summary.messages += pending
+        summary.channels_done += 1
+
+    async def _write_chunk(self, guild_id, channel_id, counts, checkpoint):
+        rows = [(guild_id, user_id, count, False, False) for user_id, count in counts.items()]
+        await self.storage.write_backfill_chunk(guild_id, channel_id, rows, checkpoint)
+        self.counter_cache.apply_external_counts(guild_id, counts)
@@ -3,69 +3,223 @@ Discord client for RegularBot.
 """
 
 import os
+import sys
 import discord
 from discord.ext import tasks
 from discord import app_commands
 import asyncio
 import sqlite3
 from random import choice
-from RegularBot.config import RegularBotConfig
-import traceback
-import re
+from RegularBot.config import RegularBotConfig, GuildPolicy, CONFIG_PATH, InvalidConfigException, EmptyConfigException
+from RegularBot.counter_cache import MessageCounterCache
+from RegularBot.storage import RegularBotStorage
+from RegularBot.locks import KeyedLockTable
+from RegularBot.counting_window import CountingWindows
+from RegularBot.dispatch import DispatchQueue, ReplyJob, RoleGrantJob
+from RegularBot.backfill import HistoryBackfill
+from RegularBot.leaderboard import GuildLeaderboards
+from RegularBot.maintenance import DatabaseMaintenance
+from RegularBot.profiling import RuntimeProfiler, DEFAULT_PROFILE_SECONDS, MAX_PROFILE_SECONDS
+from RegularBot import metrics
+from RegularBot.metrics import MetricsServer
+from RegularBot.command_sync import CommandSyncer
+from RegularBot.members import MemberCache, LAZY, client_options
+from RegularBot.outbox import CrashOutbox, OutboxSender, OUTBOX_DIR, dm_channel, with_retries
+from RegularBot.errors import ExceptionAggregator, ERROR_DIGEST_SECONDS
+from RegularBot.timezones import TimezoneIndex, UserTimezoneCache, parse_timestamp, SHARED_CACHE_TTL_SECONDS
+import time as perf_time
 from datetime import datetime, time
-# import pytz
-from zoneinfo import ZoneInfo
+from typing import Literal
+
+# How often the config file is checked for changes
+CONFIG_POLL_SECONDS = 5
+# How often the message counter cache is written out to the database
+COUNTER_FLUSH_SECONDS = 30
+# How often to look for users over the threshold who are missing the role
+RECONCILE_MINUTES = 15
+# Users pulled from the database at a time during a sweep
+RECONCILE_BATCH = 500
+
+MESSAGE_SECONDS = metrics.histogram("regularbot_message_seconds", "Time spent handling each message in on_message")
+GATEWAY_EVENTS = metrics.counter("regularbot_gateway_events_total", "Events discord.py dispatched from the gateway, by type")
+RESTART_SECONDS = metrics.histogram("regularbot_restart_seconds", "Time from a crash until the replacement client was ready again, backoff included")
 
 class RegularBotException(Exception):
     """
-    Exception class which sends emergency message to maintainers upon creation
+    Exception class which reports itself to the maintainers upon creation.
+    Repeats are rolled up into the next error digest rather than sent one by one.
     """
 
     def __init__(self, bot, msg):
         super().__init__(msg)
         print("RegularBotException raised")
-        loop = asyncio.get_running_loop()
-        loop.create_task(bot.send_exception_msg(self))
+        bot.errors.report(self)
 
 class RegularBotClient(discord.Client):
     command_tree: app_commands.CommandTree
+    # Which of the launcher's processes this is; 0 when there's only one
+    worker = 0
+    # perf_counter() of the crash this client is replacing, until it's ready
+    restart_started = None
 
-    def __init__(self, intents: discord.Intents, **options):
-        super().__init__(intents=intents, options=options)
-        
+    def __init__(self, intents: discord.Intents, previous: "RegularBotClient" = None, **options):
+        # The member cache mode decides the intents, so the config has to be read first
         self.refresh_config()
-        self.sql_lock = asyncio.Lock()
-
-        if not os.path.isdir("db"):
-            os.mkdir("db")
-
-        db_name = "db/"+self.config['sql_db']
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        
-        # check if the user table exists
-        res = cursor.execute("SELECT name FROM sqlite_master WHERE name='users'")
-        user_table = res.fetchone()
-        if not user_table:
-            print("need to create user_table")
-            cursor.execute("CREATE TABLE users(guild_id, user_id, message_count, encouraged, congratulated)")
-        
-        # check if the timezone table exists
-        res = cursor.execute("SELECT name FROM sqlite_master WHERE name='timezones'")
-        tz_table = res.fetchone()
-        if not tz_table:
-            print("need to create tz_table")
-            cursor.execute("CREATE TABLE timezones(user_id, timezone)")
+        intents, member_options = client_options(self.config.member_cache_mode, intents)
+        super().__init__(intents=intents, **member_options, **options)
+
+        self.members = MemberCache(self.config.member_cache_mode, self.config.member_cache_size)
+        self.failed_config_mtime = None
+        # Serializes work per (guild_id, user_id) for messages, and per (None, user_id)
+        # for timezones, so unrelated users never wait on each other
+        self.user_locks = KeyedLockTable()
+        # Per-guild caps on how many of a user's messages count in a window
+        self.counting_windows = CountingWindows()
+
+        self.storage = RegularBotStorage("db/"+self.config['sql_db'])
+        self.counter_cache = MessageCounterCache(self.storage)
+        # A flush kicked off by on_message; only one at a time
+        self._flush_task = None
+        self.leaderboards = GuildLeaderboards(self.storage)
+        # Replies and role grants go out in the background so on_message never waits on REST
+        self.dispatch_queue = DispatchQueue(on_give_up=self.dispatch_failed)
+        self.backfill = HistoryBackfill(self.storage, self.counter_cache)
+        self.maintenance = DatabaseMaintenance(self.storage, self.counter_cache, self.leaderboards, self.members, self.dispatch_queue)
+        # The scheduled run and /rbmaintain never overlap
+        self.maintenance_lock = asyncio.Lock()
+        # guild_id -> running backfill task
+        self.backfills: dict[int, asyncio.Task] = {}
+        self.metrics_server = None
+        # Crash notices from earlier runs; each worker process has its own
+        self.outbox = CrashOutbox(OUTBOX_DIR if not self.worker else f"{OUTBOX_DIR}-{self.worker}")
+        self.outbox_task = None
+        self.errors = ExceptionAggregator()
+        # Idle (and free) until a maintainer runs /rbprofile
+        self.profiler = RuntimeProfiler(self.config.profile_dir, self.worker)
+        # Built once, used to validate and autocomplete zone names
+        self.timezones = previous.timezones if previous is not None else TimezoneIndex()
+        # Other processes can change a user's zone when sharded across processes, so don't trust it forever
+        self.user_timezones = UserTimezoneCache(self.timezones, ttl=SHARED_CACHE_TTL_SECONDS if self.config.shard_processes > 1 else None)
         
         self.command_tree = app_commands.CommandTree(self)
         self.register_commands()
+        self.command_syncer = CommandSyncer(self.command_tree, self.storage)
+
+        if previous is not None:
+            self.inherit(previous)
+
+    def inherit(self, previous: "RegularBotClient"):
+        """
+        Carry state over from a client that crashed, so a restart doesn't start
+        cold. Only plain data comes across: discord.py objects belong to the old
+        connection and asyncio primitives to the old event loop, so members,
+        locks and the like start fresh.
+        """
+        # Unflushed counts are carried too; they're written by this client's first flush
+        self.counter_cache.entries = previous.counter_cache.entries
+        self.counter_cache.dirty = previous.counter_cache.dirty
+        self.leaderboards.boards = previous.leaderboards.boards
+        self.leaderboards.thresholds = previous.leaderboards.thresholds
+        self.leaderboards.dirty = previous.leaderboards.dirty
+        self.leaderboards.stale = previous.leaderboards.stale
+        self.counting_windows.windows = previous.counting_windows.windows
+        self.user_timezones.entries = previous.user_timezones.entries
+        # Jobs only hold IDs, and the queue keeps its backlog while stopped
+        self.dispatch_queue = previous.dispatch_queue
+        self.dispatch_queue.on_give_up = self.dispatch_failed
+        self.maintenance.dispatch_queue = self.dispatch_queue
+        self.errors = previous.errors
+
+    async def setup_hook(self):
+        if self.config.metrics_enabled:
+            # Each process gets its own port, counting up from the configured one
+            self.metrics_server = MetricsServer(self.config.metrics_host, self.config.metrics_port + self.worker)
+            await self.metrics_server.start()
+        await self.storage.open()
+        # Boards carried over from a crashed client are at least as new as the saved ones
+        if not self.leaderboards.boards:
+            await self.leaderboards.load()
+        # We're logged in by now, so REST works; no need to wait for the gateway
+        self.outbox_task = asyncio.create_task(self.deliver_crash_notices())
+        self.dispatch_queue.start(self)
+        self.regularbot_flush_counters.start()
+        self.regularbot_watch_config.start()
+        self.regularbot_reconcile_roles.start()
+        self.regularbot_send_error_digest.start()
+        self.regularbot_maintain_database.change_interval(hours=self.config.maintenance_hours)
+        self.regularbot_maintain_database.start()
+
+    async def close(self):
+        # Make sure no counts are lost on shutdown
+        if self.regularbot_flush_counters.is_running():
+            self.regularbot_flush_counters.cancel()
+        if self.regularbot_watch_config.is_running():
+            self.regularbot_watch_config.cancel()
+        if self.regularbot_reconcile_roles.is_running():
+            self.regularbot_reconcile_roles.cancel()
+        if self.regularbot_send_error_digest.is_running():
+            self.regularbot_send_error_digest.cancel()
+        if self.regularbot_maintain_database.is_running():
+            self.regularbot_maintain_database.cancel()
+        # Whatever wasn't delivered stays in the outbox for next time, along with any unsent errors
+        if self.outbox_task is not None:
+            self.outbox_task.cancel()
+            await asyncio.gather(self.outbox_task, return_exceptions=True)
+            self.outbox_task = None
+        messages, snapshot = self.errors.digest()
+        for text in messages:
+            self.outbox.put(text)
+        if snapshot:
+            self.errors.mark_sent(snapshot)
+        # Keep whatever a running profile has collected so far
+        if self.profiler.running:
+            print(f"profile cut short by shutdown, results in {await self.profiler.stop()}")
+        # Backfills are checkpointed, so they can just be stopped and resumed later
+        for task in self.backfills.values():
+            task.cancel()
+        await asyncio.gather(*self.backfills.values(), return_exceptions=True)
+        await self.dispatch_queue.stop()
+        await self.flush_counters()
+        await self.storage.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+            self.metrics_server = None
+        await super().close()
 
     async def on_ready(self):
         print(f"Logged in as {self.user}")
-        await self.command_tree.sync()
+        if self.restart_started is not None:
+            latency = perf_time.perf_counter() - self.restart_started
+            self.restart_started = None
+            RESTART_SECONDS.observe(latency)
+            print(f"back up {latency:.1f}s after the crash")
+        # on_ready fires again after every reconnect, and there's nothing new to do then
+        if self.regularbot_change_presence.is_running():
+            return
+        if self.syncs_commands():
+            synced = await self.command_syncer.sync(guild_ids=(self.config.debug_guild_id,))
+            print(f"synced commands for {len(synced)} scope(s)" if synced else "commands unchanged, skipped sync")
         self.regularbot_change_presence.start()
 
+    def syncs_commands(self):
+        """
+        Whether this process is the one that syncs slash commands
+        """
+        return True
+
+    def dispatch(self, event, /, *args, **kwargs):
+        # Counted here rather than in an on_ handler, which would cost a Task per event
+        GATEWAY_EVENTS.child("type", event).inc()
+        super().dispatch(event, *args, **kwargs)
+
     async def on_message(self, message: discord.Message):
+        start = perf_time.perf_counter()
+        try:
+            await self.handle_message(message)
+        finally:
+            MESSAGE_SECONDS.observe(perf_time.perf_counter() - start)
+
+    async def handle_message(self, message: discord.Message):
         # Message info
         author = message.author
         channel = message.channel
@@ -74,11 +228,12 @@ class RegularBotClient(discord.Client):
             return
 
         guild = message.guild
-        guild_key = str(guild.id)
+        # Hold on to one snapshot for the whole message, even if a reload swaps it out
+        config = self.config
         
         # Check if the guild config is present
         # TODO make it actually create a default config
-        if not (guild_config := self.config['guilds'].get(guild_key)):
+        if not (policy := config.guilds.get(guild.id)):
             raise RegularBotException(self, f"Guild {guild.id} not present in config file!")
 
         # Ignore bots
@@ -86,84 +241,208 @@ class RegularBotClient(discord.Client):
             return
 
         # Ignore blacklisted channels
-        if channel.id in guild_config['regular']['ignore_channels']:
+        if channel.id in policy.ignore_channels:
             return
 
         # Quit early if user already has the role
-        if author.get_role(guild_config['regular']['role_id']):
+        if author.get_role(policy.role_id):
             return
+
+        # Drop messages over the guild's count_limit before they cost anything
+        if not self.counting_windows.allow(policy, author.id):
+            return
+        self.members.remember(author)
         
-        # Need these variables outside of the `async with` scope
+        # Counting happens entirely in memory; the cache is written out in
+        # batches by regularbot_flush_counters
+        threshold = policy.message_threshold
+        async with self.user_locks.hold((guild.id, author.id)):
+            result = await self.counter_cache.record_message(guild.id, author.id, threshold)
+        message_count = result.message_count
+        give_role = result.give_role
+        self.leaderboards.record(guild.id, author.id, message_count, threshold)
+
         reply = ""
-        give_role = False
-        message_count = 0
-        encouraged = False
-        congratulated = False
-
-        # It's very possible for people to send messages faster than the bot
-        # can handle them, so we need to ensure database read/write is atomic
-        async with self.sql_lock:
-            try:
-                # load up the database
-                conn = sqlite3.connect("db/"+self.config['sql_db'])
-                cursor = conn.cursor()
-
-                # Get user's message count, creating a new row in the table if necessary.
-                res = cursor.execute(f"SELECT message_count, encouraged, congratulated FROM users WHERE user_id={author.id} AND guild_id={guild.id}")
-                db_user = res.fetchone()
-                if not db_user:
-                    print("user not found, insert into table")
-                    cursor.execute(f"INSERT INTO users VALUES ({guild.id}, {author.id}, {0}, {False}, {False})")
-                    message_count = 1
-                    encouraged = False
-                    congratulated = False
-                else:
-                    message_count = db_user[0] + 1
-                    encouraged = db_user[1]
-                    congratulated = db_user[2]
-
-                # If it's greater than the number indicated in config, give the role
-                threshold = guild_config['regular']['message_threshold']
-                if (message_count >= threshold):
-                    # only send the message if they haven't gotten it already
-                    # if the message was sent before but role assignment failed for some reason,
-                    # this stops us from spamming the user while still reattempting role assignment
-                    if not congratulated:
-                        reply = guild_config['regular']['congrats']
-                        reply = reply.format(user=author.display_name, message_count=message_count)
-                        cursor.execute(f"UPDATE users SET congratulated = {True} WHERE user_id={author.id} AND guild_id={guild.id}")
-                    give_role = True
-                # Or, send a message if it's half of the indicated number (and they haven't gotten
-                # a halfway message yet.)
-                elif (message_count < threshold) and (message_count >= (threshold / 2)) and (not encouraged):
-                    reply = guild_config['regular']['encouragement']
-                    reply = reply.format(user=author.display_name, message_count=message_count)
-                    cursor.execute(f"UPDATE users SET encouraged = {True} WHERE user_id={author.id} AND guild_id={guild.id}")
-                # Finally, log the rest of the messages, if debug is enabled.
-                elif self.config['debug']['enabled'] and (channel.id == self.config['debug']['channel_id']):
-                    print(f"Received message from {author.display_name} in guild {guild.id}, channel {channel.id}")
-                    print(f"According to the database, in this guild, user {author.id} has sent **{message_count} messages** and **{"HAS" if encouraged else "HAS NOT"}** received their halfway encouragement message")
-
-                # Increment the message count
-                cursor.execute(f"UPDATE users SET message_count = {message_count} WHERE user_id={author.id} AND guild_id={guild.id}")
-            
-            finally:
-                # Write out the database
-                conn.commit()
-                conn.close()
+        if result.congratulate:
+            reply = policy.congrats.render(user=author.display_name, message_count=message_count)
+        # Or, send a message if it's half of the indicated number (and they haven't gotten
+        # a halfway message yet.)
+        elif result.encourage:
+            reply = policy.encouragement.render(user=author.display_name, message_count=message_count)
+        # Finally, log the rest of the messages, if debug is enabled.
+        elif not give_role and config.debug_enabled and (channel.id == config.debug_channel_id):
+            encouraged = (await self.counter_cache.get(guild.id, author.id)).encouraged
+            print(f"Received message from {author.display_name} in guild {guild.id}, channel {channel.id}")
+            print(f"According to the database, in this guild, user {author.id} has sent **{message_count} messages** and **{"HAS" if encouraged else "HAS NOT"}** received their halfway encouragement message")
+
+        # Don't make this message wait on the write, just kick it off
+        if self.counter_cache.needs_flush() and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush_counters())
         
         # send a reply, if we have one
         if reply:
-            await message.reply(reply)
+            self.dispatch_queue.enqueue(ReplyJob(guild.id, channel.id, message.id, reply))
 
-        # attempt to give the role
+        # attempt to give the role. Grants still pending for this member are deduplicated.
         if give_role:
-            role_id = guild_config['regular']['role_id']
-            role_snowflake = guild.get_role(role_id)
-            if role_snowflake:
-                await author.add_roles(role_snowflake)
-            else:
-                raise RegularBotException(self, f"Can't find role {role_id}.\nAvailable roles: {[r for r in message.guild.roles]}")
+            self.dispatch_queue.enqueue(RoleGrantJob(guild.id, author.id, policy.role_id))
+
+    @tasks.loop(seconds=COUNTER_FLUSH_SECONDS)
+    async def regularbot_flush_counters(self):
+        await self.flush_counters()
+
+    async def flush_counters(self):
+        try:
+            written = await self.counter_cache.flush()
+        except sqlite3.Error as e:
+            # Leave everything dirty, we'll try again on the next flush
+            print(f"failed to flush message counts: {e}")
+            return
+        try:
+            await self.leaderboards.refresh(self.config.guilds.values())
+        except sqlite3.Error as e:
+            print(f"failed to save leaderboards: {e}")
+        if written and self.config.debug_enabled:
+            print(f"flushed {written} message counts")
+            print(f"user lock contention: {self.user_locks.stats}")
+            print(f"dispatch queue: {self.dispatch_queue}")
+
+    async def deliver_crash_notices(self):
+        delivered = await OutboxSender(self, self.config.notify_ids).deliver(self.outbox)
+        if delivered:
+            print(f"delivered {delivered} crash notice(s)")
+
+    def dispatch_failed(self, job, exc):
+        # A missing role or guild needs a maintainer to fix the config. Creating
+        # the exception is what notifies them; raising it here would kill a worker.
+        if isinstance(exc, LookupError):
+            RegularBotException(self, str(exc))
+
+    @tasks.loop(minutes=RECONCILE_MINUTES)
+    async def regularbot_reconcile_roles(self):
+        """
+        Catch up on role grants that failed. Users who turn out to already have
+        the role are marked reconciled, so later sweeps skip them.
+        """
+        # Make sure recent threshold crossings are in the database
+        await self.flush_counters()
+
+        config = self.config
+        for policy in config.guilds.values():
+            guild = self.get_guild(policy.guild_id)
+            if guild is None or guild.get_role(policy.role_id) is None:
+                continue
+            try:
+                granted, reconciled = await self.reconcile_guild(guild, policy)
+            except (sqlite3.Error, discord.HTTPException) as e:
+                # One guild's failure shouldn't stop the others, or the loop
+                print(f"failed to reconcile guild {policy.guild_id}: {e}")
+                continue
+            if (granted or reconciled) and config.debug_enabled:
+                print(f"reconciled guild {policy.guild_id}: {granted} roles queued, {reconciled} confirmed")
+
+    async def reconcile_guild(self, guild: discord.Guild, policy: GuildPolicy):
+        """
+        Reconciles one guild. Returns (roles queued, users confirmed).
+        """
+        granted = 0
+        reconciled = []
+        departed = []
+        returned = []
+        after = (0, 0)
+        while True:
+            rows = await self.storage.get_unreconciled(policy.guild_id, policy.message_threshold, after, RECONCILE_BATCH)
+            if not rows:
+                break
+            after = rows[-1]
+            user_ids = [user_id for _, user_id in rows]
+            noted_departed = await self.storage.get_departures(policy.guild_id, user_ids)
+
+            for user_id in user_ids:
+                # With every member cached, one we can't see has left. In lazy mode we have to ask.
+                member = self.members.get(guild, user_id)
+                if member is None and self.members.mode == LAZY:
+                    if user_id in noted_departed:
+                        # Already known to have left; pruning checks again before deleting them
+                        continue
+                    # Lookups share the guild's rate limit with role grants and replies
+                    await self.dispatch_queue.throttle(policy.guild_id)
+                    member = await self.members.resolve(guild, user_id)
+                if member is None:
+                    departed.append(user_id)
+                    continue
+                if user_id in noted_departed:
+                    # They came back, so they're not to be pruned
+                    returned.append(user_id)
+                if member.get_role(policy.role_id):
+                    reconciled.append(user_id)
+                elif self.dispatch_queue.enqueue(RoleGrantJob(policy.guild_id, user_id, policy.role_id)):
+                    granted += 1
+
+        if reconciled:
+            await self.storage.mark_reconciled(policy.guild_id, reconciled)
+        if departed:
+            await self.storage.record_departures(policy.guild_id, departed)
+        if returned:
+            await self.storage.clear_departures(policy.guild_id, returned)
+        return granted, len(reconciled)
+
+    @regularbot_reconcile_roles.before_loop
+    async def before_reconcile_roles(self):
+        # The member cache is empty until we're connected
+        await self.wait_until_ready()
+
+    async def on_raw_member_remove(self, payload: discord.RawMemberRemoveEvent):
+        # Only fires with the members intent, i.e. in full member cache mode
+        if payload.guild_id in self.config.guilds:
+            await self.storage.record_departures(payload.guild_id, (payload.user.id,))
+
+    async def on_member_join(self, member: discord.Member):
+        if member.guild.id in self.config.guilds:
+            await self.storage.clear_departures(member.guild.id, (member.id,))
+
+    @tasks.loop(hours=24)
+    async def regularbot_maintain_database(self):
+        try:
+            report = await self.maintain_database()
+        except sqlite3.Error as e:
+            # Another process may be running its own maintenance; try again next time
+            print(f"database maintenance failed: {e}")
+            return
+        print(f"database maintenance: {report}")
+
+    @regularbot_maintain_database.before_loop
+    async def before_maintain_database(self):
+        # Departures are judged against the guilds' members, which we only have once connected
+        await self.wait_until_ready()
+        # A restart doesn't start the interval over; wait out what's left of it
+        try:
+            last_run = await self.storage.get_last_maintenance(self.worker)
+        except sqlite3.Error as e:
+            print(f"couldn't read when database maintenance last ran, waiting a full interval: {e}")
+            last_run = perf_time.time()
+        if last_run is not None:
+            await asyncio.sleep(max(0, last_run + self.config.maintenance_hours * 3600 - perf_time.time()))
+
+    async def maintain_database(self, rebuild=False):
+        """
+        Archive Regulars, prune departed members and compact the database.
+        Each worker prunes its own guilds; the steps that cover the whole
+        database are left to worker 0.
+        """
+        async with self.maintenance_lock:
+            # Get every count into the users table first, so it's all archived or pruned together
+            await self.flush_counters()
+            config = self.config
+            prune_after = config.prune_departed_days * 86400 if config.prune_departed_days is not None else None
+            guilds = [(self.get_guild(guild_id), policy) for guild_id, policy in config.guilds.items()]
+            owns_database = self.worker == 0
+            report = await self.maintenance.run(
+                guilds, archive=config.archive_regulars and owns_database, prune_after_seconds=prune_after,
+                compact=owns_database, rebuild=rebuild,
+            )
+            await self.storage.set_last_maintenance(self.worker, perf_time.time())
+            return report
 
     @tasks.loop(hours=1)
     async def regularbot_change_presence(self):
@@ -190,78 +469,215 @@ class RegularBotClient(discord.Client):
         await self.change_presence(status=discord.Status.online, activity=activity)
 
     def refresh_config(self):
-        self.config = RegularBotConfig('config/config.json')
+        self.config = RegularBotConfig(CONFIG_PATH)
+
+    async def reload_config(self):
+        """
+        Build a new config snapshot off the event loop and swap it in. If the new
+        config doesn't validate, the old one stays in place and the error is raised.
+        """
+        config = await asyncio.to_thread(RegularBotConfig, CONFIG_PATH)
+        # Handlers grab self.config once, so this single assignment is the whole swap
+        self.config = config
+        if config.maintenance_hours != self.regularbot_maintain_database.hours:
+            self.regularbot_maintain_database.change_interval(hours=config.maintenance_hours)
+        return config
+
+    @tasks.loop(seconds=CONFIG_POLL_SECONDS)
+    async def regularbot_watch_config(self):
+        try:
+            mtime = (await asyncio.to_thread(os.stat, CONFIG_PATH)).st_mtime_ns
+        except OSError as e:
+            print(f"couldn't check config file: {e}")
+            return
 
-    async def send_exception_msg(self, exc):
-        traceback_fmt = traceback.format_exception(exc)
-        message_text = f"The bot encountered a fatal error with the following details: \n ```{'\n'.join(traceback_fmt)}```"
-        for id, info in self.config['maintainers'].items():
+        if mtime == self.config.mtime or mtime == self.failed_config_mtime:
+            return
 
-            if not info['notify_on_exception']:
-                continue
-            
-            user_id = int(id)
-            user = self.get_user(user_id)
-            
-            if not user.dm_channel:
-                print("creating dm...")
-                await user.create_dm()
-            
-            if user.dm_channel:
-                await user.dm_channel.send(message_text)
+        print("config file changed, reloading...")
+        try:
+            await self.reload_config()
+        except (InvalidConfigException, EmptyConfigException, ValueError, OSError) as e:
+            # Keep running on the old config rather than going down over a typo.
+            # Remember this mtime so we don't complain again until the file changes.
+            print(f"new config rejected, keeping the old one: {e}")
+            self.failed_config_mtime = mtime
+
+    @tasks.loop(seconds=ERROR_DIGEST_SECONDS)
+    async def regularbot_send_error_digest(self):
+        messages, snapshot = self.errors.digest()
+        if not messages:
+            return
+
+        recipients = self.config.notify_ids
+        failed = 0
+        for user_id in recipients:
+            try:
+                channel = await dm_channel(self, user_id)
+                for text in messages:
+                    await with_retries(lambda: channel.send(text))
+            except (discord.Forbidden, discord.NotFound) as e:
+                print(f"can't send error digest to {user_id}: {e}")
+            except (discord.HTTPException, OSError) as e:
+                print(f"failed to send error digest to {user_id}: {e}")
+                failed += 1
+
+        # If nobody got it, keep counting and try again with the next one
+        if not recipients or failed < len(recipients):
+            self.errors.mark_sent(snapshot)
+
+    async def on_error(self, event_method, *args, **kwargs):
+        # Same logging as discord.py's default, plus a report to the maintainers
+        await super().on_error(event_method, *args, **kwargs)
+        exc = sys.exc_info()[1]
+        # RegularBotExceptions reported themselves when they were created
+        if exc is not None and not isinstance(exc, RegularBotException):
+            self.errors.report(exc)
 
     def register_commands(self):
+        # Internal commands; the IDs are read on every use, so a config reload applies straight away
+        maintainers_only = app_commands.check(lambda ctx: ctx.user.id in self.config.maintainer_ids)
+
+        @self.command_tree.error
+        async def on_command_error(ctx: discord.Interaction, error: app_commands.AppCommandError):
+            if isinstance(error, app_commands.CheckFailure):
+                await ctx.response.send_message("This is an internal command, and can only be used by bot maintainers. It is not meant to be used by server admins.", ephemeral=True)
+                return
+            # Anything else gets discord.py's usual logging
+            await app_commands.CommandTree.on_error(self.command_tree, ctx, error)
 
         @self.command_tree.command(name="rbconfig", description="ONLY bot maintainers (not server admins) can execute this command_2")
-        @app_commands.guilds(discord.Object(self.config['debug']['guild_id']))
+        @app_commands.guilds(discord.Object(self.config.debug_guild_id))
+        @maintainers_only
         async def command_config(ctx):
 
-            maintainers = [int(id) for id in self.config['maintainers']]
-            if ctx.user.id not in maintainers:
-                await ctx.response.send_message("This is an internal command, and can only be used by bot maintainers. It is not meant to be used by server admins.")
-
             # Quick'n dirty way for global bot maintainers (and *only* them) to refresh the config
             print("refreshing config...")
-            self.refresh_config()
+            try:
+                await self.reload_config()
+            except (InvalidConfigException, EmptyConfigException, ValueError, OSError) as e:
+                await ctx.response.send_message(f"Config was not reloaded, the old one is still in use: {e}")
+                return
             await ctx.response.send_message("Refreshed config!")
             return
 
+        @self.command_tree.command(name="rbprofile", description="ONLY bot maintainers: profile the running bot for a while")
+        @app_commands.guilds(discord.Object(self.config.debug_guild_id))
+        @app_commands.describe(seconds=f"How long to profile for (at most {MAX_PROFILE_SECONDS})")
+        @maintainers_only
+        async def command_profile(ctx, action: Literal["start", "stop", "status"], seconds: int=DEFAULT_PROFILE_SECONDS):
+
+            if action == "status":
+                await ctx.response.send_message(self.profiler.status(), ephemeral=True)
+                return
+            if action == "start":
+                if self.profiler.running:
+                    await ctx.response.send_message(f"Already {self.profiler.status()}", ephemeral=True)
+                    return
+                # Pick up a changed output directory from a config reload
+                self.profiler.output_dir = self.config.profile_dir
+                path = await self.profiler.start(seconds)
+                await ctx.response.send_message(f"Profiling for {self.profiler.seconds}s, results will be in `{path}`", ephemeral=True)
+                return
+
+            if not self.profiler.running:
+                await ctx.response.send_message("Not profiling", ephemeral=True)
+                return
+            # Writing the results can take a moment
+            await ctx.response.defer(ephemeral=True)
+            path = await self.profiler.stop()
+            await ctx.followup.send(f"Profile stopped, results are in `{path}`", ephemeral=True)
+
+        @self.command_tree.command(name="rbsync", description="ONLY bot maintainers: re-sync slash commands with Discord")
+        @app_commands.guilds(discord.Object(self.config.debug_guild_id))
+        @maintainers_only
+        async def command_sync(ctx):
+
+            await ctx.response.defer(ephemeral=True)
+            synced = await self.command_syncer.sync(guild_ids=(self.config.debug_guild_id,), force=True)
+            await ctx.followup.send(f"Synced commands for {len(synced)} scope(s)", ephemeral=True)
+
+        @self.command_tree.command(name="rbmaintain", description="ONLY bot maintainers: archive, prune and compact the database now, rebuilding it if needed")
+        @app_commands.guilds(discord.Object(self.config.debug_guild_id))
+        @maintainers_only
+        async def command_maintain(ctx):
+
+            await ctx.response.defer(ephemeral=True)
+            try:
+                # Switching an old database to incremental vacuum blocks writes, so it only happens on request
+                report = await self.maintain_database(rebuild=True)
+            except sqlite3.Error as e:
+                await ctx.followup.send(f"Database maintenance failed: {e}", ephemeral=True)
+                return
+            print(f"database maintenance: {report}")
+            await ctx.followup.send(f"Database maintenance done: {report}", ephemeral=True)
+
+        @self.command_tree.command(name="rbbackfill", description="ONLY bot maintainers: count messages sent in a server before the bot joined")
+        @app_commands.guilds(discord.Object(self.config.debug_guild_id))
+        @maintainers_only
+        async def command_backfill(ctx, guild_id: str):
+
+            try:
+                guild = self.get_guild(int(guild_id))
+            except ValueError:
+                guild = None
+            if guild is None:
+                await ctx.response.send_message(f"I'm not in a server with ID {guild_id}", ephemeral=True)
+                return
+            if not (policy := self.config.guilds.get(guild.id)):
+                await ctx.response.send_message(f"Guild {guild.id} not present in config file!", ephemeral=True)
+                return
+            if guild.id in self.backfills:
+                await ctx.response.send_message(f"A backfill for {guild.name} is already running", ephemeral=True)
+                return
+
+            await ctx.response.send_message(f"Backfilling message counts for {guild.name}. Re-running this command after an interruption picks up where it left off.", ephemeral=True)
+
+            async def run_backfill():
+                try:
+                    summary = await self.backfill.run(guild, policy)
+                except Exception as e:
+                    print(f"backfill of guild {guild.id} stopped: {e}")
+                    await ctx.followup.send(f"Backfill of {guild.name} stopped early ({e}). Run it again to resume.", ephemeral=True)
+                    return
+                finally:
+                    del self.backfills[guild.id]
+                    # Even a partial backfill changed counts the leaderboards never saw
+                    self.leaderboards.invalidate(guild.id)
+                print(f"backfill of guild {guild.id} finished: {summary}")
+                try:
+                    await ctx.followup.send(f"Backfill of {guild.name} finished: {summary}", ephemeral=True)
+                except discord.HTTPException:
+                    # The interaction expired, it's in the log anyway
+                    pass
+
+            self.backfills[guild.id] = asyncio.create_task(run_backfill())
+
         @self.command_tree.command(name="rbhowfar", description="Check how far you are from reaching Regular status")
         async def command_howfar(ctx):
             user = ctx.user
             guild = ctx.guild
             
-            guild_key = str(guild.id)
-            
             # Check if the guild config is present
             # TODO make it actually create a default config
-            if not (guild_config := self.config['guilds'].get(guild_key)):
+            if not (policy := self.config.guilds.get(guild.id)):
                 raise RegularBotException(self, f"Guild {guild.id} not present in config file!")
 
             if user.bot or user.system:
                 return
             
-            if user.get_role(guild_config['regular']['role_id']):
+            if user.get_role(policy.role_id):
                 await ctx.response.send_message(f"{user.display_name}, you're already a Regular here!")
                 return
 
-            async with self.sql_lock:
-                try:
-                    # load up the database
-                    conn = sqlite3.connect("db/"+self.config['sql_db'])
-                    cursor = conn.cursor()
-
-                    # Get user's message count, creating a new row in the table if necessary.
-                    res = cursor.execute(f"SELECT message_count FROM users WHERE user_id={user.id} AND guild_id={guild.id}")
-                    message_count = res.fetchone()[0]
-                finally:
-                    cursor.close()
+            # Go through the counter cache so counts that haven't been flushed yet are included
+            message_count = await self.counter_cache.read_count(guild.id, user.id)
             
             if not message_count:
                 await ctx.response.send_message(f"{user.display_name}, I've never seen you send a message here!")
                 return
             else:
-                threshold = guild_config['regular']['message_threshold']
+                threshold = policy.message_threshold
 
                 # handle the case where the user has sent more messages than required, but they don't have the role. This might happen if the role assignment failed.
                 if message_count >= threshold:
@@ -271,107 +687,100 @@ class RegularBotClient(discord.Client):
                 await ctx.response.send_message(f"{user.display_name}, you've sent {message_count} messages since I joined the server. That means you've got {threshold - message_count} messages to go. Keep it up!")
                 return
 
-        @self.command_tree.command(name="rbtimestamp", description="Generate a dynamic timestamp (accepts 12 or 24 hour time)")
-        async def command_timestamp(ctx, timestamp: str, timezone: str=None):
-            timestamp_cleaned = timestamp.strip()
+        @self.command_tree.command(name="rbleaderboard", description="See who has sent the most messages in this server")
+        async def command_leaderboard(ctx):
+            guild = ctx.guild
+            if guild is None:
+                await ctx.response.send_message("The leaderboard only works in a server!", ephemeral=True)
+                return
+            if not (policy := self.config.guilds.get(guild.id)):
+                raise RegularBotException(self, f"Guild {guild.id} not present in config file!")
 
-            # matches timestamps of the form H:MM or HH:MM, 24-hour or 12-hour, with or without a space between the time and AM/PM
-            timestamp_re = re.search(r"^(((([01]?\d)|2[0-3])(:(([0-5]\d)|60))?)|(((0?\d)|1[0-2])(:(([0-5]\d)))?( ?[AP]M)?))$", timestamp, re.IGNORECASE)
-            if not timestamp_re:
-                # send a private error message
-                pass
-            
-            # if no timezone provided use that user's default
-            if timezone:
-                timezone_cleaned = timezone.strip()
-            else:
-                async with self.sql_lock:
-                    try:
-                        # load up the database
-                        conn = sqlite3.connect("db/"+self.config['sql_db'])
-                        cursor = conn.cursor()
-                        
-                        author = ctx.user
-
-                        # Create a new row in the timezone table if necessary.
-                        res = cursor.execute(f"SELECT timezone FROM timezones WHERE user_id={author.id}")
-                        db_user = res.fetchone()
-
-                        if db_user:
-                            timezone_cleaned = db_user[0].strip()
-                        else:
-                            await ctx.response.send_message(f"Couldn't find a timezone to use! Include the `timezone` parameter in your command, or run /rbtimezone to set your preferred default timezone", ephemeral=True)
-                            return
-                    finally:
-                        cursor.close()
-
-            if not re.match(r"^[A-Z][a-z]+\/[A-Z]+[a-z]+(_[A-Z][a-z]+)*$", timezone_cleaned):
-                await ctx.response.send_message(f"{timezone_cleaned} is not a valid timezone! Please enter timezones in `Region/City` format. You can get your timezone from this site: https://zones.arilyn.cc/", ephemeral=True)
+            top = self.leaderboards.top(guild.id)
+            if not top:
+                await ctx.response.send_message("Nobody's on the leaderboard yet. Start chatting!")
                 return
+            lines = [f"{rank}. <@{user_id}> - {count} messages" for rank, (user_id, count) in enumerate(top, start=1)]
+            await ctx.response.send_message(f"**Most active members** ({policy.message_threshold} messages makes a Regular)\n" + "\n".join(lines),
+                                            allowed_mentions=discord.AllowedMentions.none())
+
+        @self.command_tree.command(name="rbprogress", description="ONLY bot maintainers: see who in a server is closest to becoming a Regular")
+        @app_commands.guilds(discord.Object(self.config.debug_guild_id))
+        @maintainers_only
+        async def command_progress(ctx, guild_id: str):
 
             try:
-                tz = ZoneInfo(timezone_cleaned)
-            except:
-                await ctx.response.send_message(f"{timezone_cleaned} is not a valid timezone! Please enter timezones in `Region/City` format. You can get your timezone from this site: https://zones.arilyn.cc/", ephemeral=True)
+                policy = self.config.guilds.get(int(guild_id))
+            except ValueError:
+                policy = None
+            if policy is None:
+                await ctx.response.send_message(f"Guild {guild_id} not present in config file!", ephemeral=True)
+                return
+
+            closest = self.leaderboards.closest(policy)
+            if not closest:
+                await ctx.response.send_message(f"Nobody in {policy.name or policy.guild_id} is working towards Regular yet", ephemeral=True)
+                return
+            threshold = policy.message_threshold
+            lines = [f"{rank}. <@{user_id}> ({user_id}) - {count}/{threshold} ({count * 100 // threshold}%)" for rank, (user_id, count) in enumerate(closest, start=1)]
+            await ctx.response.send_message(f"**Closest to Regular in {policy.name or policy.guild_id}**\n" + "\n".join(lines),
+                                            ephemeral=True, allowed_mentions=discord.AllowedMentions.none())
+
+        @self.command_tree.command(name="rbtimestamp", description="Generate a dynamic timestamp (accepts 12 or 24 hour time)")
+        async def command_timestamp(ctx, timestamp: str, timezone: str=None):
+            parsed = parse_timestamp(timestamp)
+            if parsed is None:
+                await ctx.response.send_message(f"{timestamp.strip()} isn't a time I understand! Try something like `13:30`, `1:30 PM` or `9am`.", ephemeral=True)
                 return
+            hour, minute = parsed
 
-            # is it AM/PM format?
-            is_12hour = timestamp_cleaned[-1] in ['m', 'M']
-            if is_12hour:
-                ampm = timestamp_cleaned[-2:]
-                timestamp_cleaned = timestamp_cleaned[:-2].strip()
-                timestamp_split = timestamp_cleaned.split(':')
-                hour = timestamp_split[0]
-                minute = timestamp_split[1] if len(timestamp_split) == 2 else "0"
-                hour = int(hour)
-                minute = int(minute)
-                if ampm[0] in ['p', 'P']:
-                    hour += 12
+            # if no timezone provided use that user's default
+            if timezone:
+                tz = self.timezones.zone(timezone)
+                if tz is None:
+                    await ctx.response.send_message(f"{timezone.strip()} is not a valid timezone! Please enter timezones in `Region/City` format. You can get your timezone from this site: https://zones.arilyn.cc/", ephemeral=True)
+                    return
             else:
-                timestamp_split = timestamp_cleaned.split(':')
-                hour = timestamp_split[0]
-                minute = timestamp_split[1] if len(timestamp_split) == 2 else "0"
-                hour = int(hour)
-                minute = int(minute)
+                tz = await self.user_timezones.resolve(ctx.user.id, self.storage)
+                if tz is None:
+                    await ctx.response.send_message(f"Couldn't find a timezone to use! Include the `timezone` parameter in your command, or run /rbtimezone to set your preferred default timezone", ephemeral=True)
+                    return
 
             stamp = datetime.now(tz).replace(hour=hour, minute=minute, second=0)
             await ctx.response.send_message(f"Copy and paste this text to send a dynamic timestamp for {tz}::{str(hour).zfill(2)}:{str(minute).zfill(2)}: `<t:{int(stamp.timestamp())}:t>`", ephemeral=True)
 
         @self.command_tree.command(name="rbtimezone", description="Set your default timezone to use with /rbtimestamp (you can find yours at https://zones.arilyn.cc/)")
         async def command_timezone(ctx, timezone: str):
-            timezone_cleaned = timezone.strip()
-            if not re.match(r"^[A-Z][a-z]+\/[A-Z]+[a-z]+(_[A-Z][a-z]+)*$", timezone_cleaned):
-                await ctx.response.send_message(f"{timezone_cleaned} is not a valid timezone! Please enter timezones in `Region/City` format. You can get your timezone from this site: https://zones.arilyn.cc/", ephemeral=True)
+            timezone_cleaned = self.timezones.lookup(timezone)
+            if timezone_cleaned is None:
+                await ctx.response.send_message(f"{timezone.strip()} is not a valid timezone! Please enter timezones in `Region/City` format. You can get your timezone from this site: https://zones.arilyn.cc/", ephemeral=True)
                 return
 
-            try:
-                tz = ZoneInfo(timezone_cleaned)
-            except:
-                await ctx.response.send_message(f"{timezone_cleaned} is not a valid timezone! Please enter timezones in `Region/City` format. You can get your timezone from this site: https://zones.arilyn.cc/", ephemeral=True)
-                return
+            async with self.user_locks.hold((None, ctx.user.id)):
+                await self.storage.set_timezone(ctx.user.id, timezone_cleaned)
+                self.user_timezones.put(ctx.user.id, self.timezones.zone(timezone_cleaned))
 
-            async with self.sql_lock:
-                try:
-                    # load up the database
-                    conn = sqlite3.connect("db/"+self.config['sql_db'])
-                    cursor = conn.cursor()
-                    
-                    author = ctx.user
-
-                    # Create a new row in the timezone table if necessary.
-                    res = cursor.execute(f"SELECT timezone FROM timezones WHERE user_id={author.id}")
-                    db_user = res.fetchone()
-                    if not db_user:
-                        print("user not found, insert into table")
-                        cursor.execute(f"INSERT INTO timezones VALUES ({author.id}, \"Etc/UTC\")")
-
-                    # Get user's message count, creating a new row in the table if necessary.
-                    res = cursor.execute(f"UPDATE timezones SET timezone=\"{timezone_cleaned}\" WHERE user_id={author.id}")
-
-                    await ctx.response.send_message(f"Set your default timezone to {timezone_cleaned}", ephemeral=True)
-                finally:
-                    conn.commit()
-                    conn.close()
+            await ctx.response.send_message(f"Set your default timezone to {timezone_cleaned}", ephemeral=True)
+
+        @command_timestamp.autocomplete("timezone")
+        @command_timezone.autocomplete("timezone")
+        async def autocomplete_timezone(ctx, current: str):
+            return [app_commands.Choice(name=name, value=name) for name in self.timezones.complete(current)]
 
         # TODO
         # add a command to edit config
+
+class RegularBotShardedClient(RegularBotClient, discord.AutoShardedClient):
+    """
+    RegularBotClient spread over several gateway connections. By default it
+    runs every shard itself; the launcher in main.py can instead give each of
+    several processes its own `shard_ids`.
+    """
+
+    def __init__(self, intents: discord.Intents, worker=0, **options):
+        self.worker = worker
+        super().__init__(intents, **options)
+
+    def syncs_commands(self):
+        # Commands are per application, not per shard, so only the process with shard 0 syncs them
+        return self.shard_ids is None or 0 in self.shard_ids
@@ -0,0 +1,56 @@
+"""
+Slash command syncing for RegularBot.
+
+Syncing is a rate-limited REST call per scope, and on_ready fires on every
+reconnect and every crash reboot. Instead of syncing each time, the commands
+registered for each scope are hashed and compared against the hash stored
+from the last successful sync, and only scopes that changed are synced.
+"""
+
+import hashlib
+import json
+import discord
+from discord import app_commands
+
+# Stored scope for the global commands; guild scopes are stored by guild ID
+GLOBAL_SCOPE = 0
+
+def command_hash(tree: app_commands.CommandTree, guild_id=None):
+    """
+    Hash of the payload that syncing this scope would send to Discord
+    """
+    guild = discord.Object(guild_id) if guild_id else None
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands(guild=guild)),
+                     key=lambda command: (command.get("type", 1), command["name"]))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+class CommandSyncer:
+
+    def __init__(self, tree: app_commands.CommandTree, storage):
+        self.tree = tree
+        self.storage = storage
+
+    async def sync(self, guild_ids=(), force=False):
+        """
+        Syncs the global commands and the given guilds' commands, skipping
+        scopes whose commands haven't changed unless `force` is set. Scopes
+        that were synced before are always checked, so removing every command
+        from a guild still clears them. Returns the scopes that were synced.
+        """
+        stored = await self.storage.get_command_hashes()
+        scopes = {GLOBAL_SCOPE, *guild_ids, *stored}
+
+        synced = []
+        for scope in sorted(scopes):
+            new_hash = command_hash(self.tree, scope)
+            if not force and stored.get(scope) == new_hash:
+                continue
+            try:
+                await self.tree.sync(guild=discord.Object(scope) if scope != GLOBAL_SCOPE else None)
+            except discord.HTTPException as e:
+                # Leave the old hash, so it's retried next time
+                print(f"failed to sync commands for scope {scope}: {e}")
+                continue
+            await self.storage.set_command_hash(scope, new_hash)
+            synced.append(scope)
+        return synced
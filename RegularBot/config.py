@@ -1,17 +1,150 @@
 """
 Config class for RegularBot. Just a dict with some extra methods.
+
+On load the config is validated, and each guild is compiled into an immutable
+GuildPolicy, so the message handler never has to dig through nested dicts or
+convert IDs. A RegularBotConfig is never modified after it's built; reloading
+means building a new one and swapping it in.
 """
 
 import json
+import os
+from dataclasses import dataclass
+from string import Formatter
+
+# Relative to the working directory the bot and its scripts are run from
+CONFIG_PATH = 'config/config.json'
 
 class EmptyConfigException(BaseException):
     pass
 
+class InvalidConfigException(Exception):
+    pass
+
+def _to_id(value, where):
+    """
+    Discord IDs are ints, but they're usually written as strings in the json
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise InvalidConfigException(f"{where} must be a Discord ID, got {value!r}")
+
+def _require(section: dict, key, kind, where):
+    if key not in section:
+        raise InvalidConfigException(f"{where} is missing '{key}'")
+    value = section[key]
+    if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+        raise InvalidConfigException(f"{where}.{key} has the wrong type, got {value!r}")
+    return value
+
+class MessageTemplate:
+    """
+    A reply template, split into literal text and fields once at load time
+    """
+    FIELDS = frozenset(("user", "message_count"))
+
+    __slots__ = ("text", "parts")
+
+    def __init__(self, text, where):
+        self.text = text
+        parts = []
+        try:
+            parsed = list(Formatter().parse(text))
+        except ValueError as e:
+            raise InvalidConfigException(f"{where} is not a valid template: {e}")
+        for literal, field, spec, conversion in parsed:
+            if literal:
+                parts.append((literal, None))
+            if field is None:
+                continue
+            if field not in self.FIELDS or spec or conversion:
+                raise InvalidConfigException(f"{where} uses unknown field {{{field}}}, only {sorted(self.FIELDS)} are allowed")
+            parts.append((None, field))
+        self.parts = tuple(parts)
+
+    def render(self, user, message_count):
+        values = {"user": user, "message_count": message_count}
+        return "".join(literal if field is None else str(values[field]) for literal, field in self.parts)
+
+@dataclass(frozen=True, slots=True)
+class GuildPolicy:
+    guild_id: int
+    name: str
+    role_id: int
+    message_threshold: int
+    encouragement: MessageTemplate
+    congrats: MessageTemplate
+    ignore_channels: frozenset[int]
+    # (messages, seconds): count at most this many messages per user in any window this long.
+    # None counts every message.
+    count_limit: tuple[int, float] | None = None
+
+    @classmethod
+    def compile(cls, guild_key, guild_config):
+        where = f"guilds.{guild_key}"
+        if not isinstance(guild_config, dict):
+            raise InvalidConfigException(f"{where} must be an object")
+        regular = _require(guild_config, 'regular', dict, where)
+        where_regular = f"{where}.regular"
+
+        threshold = _require(regular, 'message_threshold', int, where_regular)
+        if threshold < 1:
+            raise InvalidConfigException(f"{where_regular}.message_threshold must be at least 1")
+
+        ignore_channels = _require(regular, 'ignore_channels', list, where_regular)
+
+        # Absent or null counts every message
+        count_limit = None
+        if regular.get('count_limit') is not None:
+            where_limit = f"{where_regular}.count_limit"
+            limit = _require(regular, 'count_limit', dict, where_regular)
+            messages = _require(limit, 'messages', int, where_limit)
+            seconds = limit.get('seconds')
+            if messages < 1:
+                raise InvalidConfigException(f"{where_limit}.messages must be at least 1")
+            if not isinstance(seconds, (int, float)) or isinstance(seconds, bool) or seconds <= 0:
+                raise InvalidConfigException(f"{where_limit}.seconds must be a positive number, got {seconds!r}")
+            count_limit = (messages, float(seconds))
+
+        return cls(
+            guild_id=_to_id(guild_key, where),
+            name=guild_config.get('name', ""),
+            role_id=_to_id(regular.get('role_id'), f"{where_regular}.role_id"),
+            message_threshold=threshold,
+            encouragement=MessageTemplate(_require(regular, 'encouragement', str, where_regular), f"{where_regular}.encouragement"),
+            congrats=MessageTemplate(_require(regular, 'congrats', str, where_regular), f"{where_regular}.congrats"),
+            ignore_channels=frozenset(_to_id(c, f"{where_regular}.ignore_channels") for c in ignore_channels),
+            count_limit=count_limit,
+        )
+
 class RegularBotConfig:
 
     def __init__(self, configPath):
         super().__init__()
+        self.path = configPath
         self.settings = {}
+        self.mtime = None
+        self.guilds: dict[int, GuildPolicy] = {}
+        self.maintainer_ids: frozenset[int] = frozenset()
+        # Maintainers who want to hear about errors
+        self.notify_ids: frozenset[int] = frozenset()
+        self.debug_enabled = False
+        self.debug_guild_id = None
+        self.debug_channel_id = None
+        self.metrics_enabled = False
+        self.metrics_host = "127.0.0.1"
+        self.metrics_port = 9464
+        self.member_cache_mode = "full"
+        self.member_cache_size = 10000
+        self.sharding_enabled = False
+        self.shard_count = None
+        self.shard_processes = 1
+        self.maintenance_hours = 24
+        self.archive_regulars = True
+        # None keeps departed members' counts forever
+        self.prune_departed_days = None
+        self.profile_dir = "db/profiles"
         self.load_config(configPath)
 
     def load_config(self, configPath):
@@ -23,12 +156,13 @@ class RegularBotConfig:
         # TODO check if the config.json actually exists, and if not, create a copy from local constants
         #           Then, exit, since fields such as IDs need to be filled out
 
+        # Grab the mtime first, so an edit that lands mid-read still looks newer next time
+        self.mtime = os.stat(configPath).st_mtime_ns
         with open(configPath, "r") as f:
             config = json.load(f)
-        
+
         if config:
-            # TODO verify all expected settings are present before assigning (and nothing extra is there either)
-            # TODO validate the settings (check that all IDs are valid, for example)
+            self.validate(config)
             if config['debug']['enabled']:
                 print("Loaded config:")
                 print(config)
@@ -36,6 +170,92 @@ class RegularBotConfig:
         else:
             raise EmptyConfigException("Config is empty!")
         return config
-    
+
+    def validate(self, config):
+        """
+        Checks every setting the bot relies on, and compiles the guilds into policies
+        """
+        if not isinstance(config, dict):
+            raise InvalidConfigException("config must be an object")
+
+        _require(config, 'sql_db', str, "config")
+        _require(config, 'process_name', str, "config")
+        presences = _require(config, 'presences', dict, "config")
+        for text, activity_type in presences.items():
+            if activity_type not in ("playing", "streaming", "listening", "watching"):
+                raise InvalidConfigException(f"presences.{text} has unknown activity type {activity_type!r}")
+
+        debug = _require(config, 'debug', dict, "config")
+        self.debug_enabled = _require(debug, 'enabled', bool, "debug")
+        self.debug_guild_id = _to_id(debug.get('guild_id'), "debug.guild_id")
+        self.debug_channel_id = _to_id(debug.get('channel_id'), "debug.channel_id")
+
+        maintainers = _require(config, 'maintainers', dict, "config")
+        for id, info in maintainers.items():
+            _require(info, 'notify_on_exception', bool, f"maintainers.{id}")
+        self.maintainer_ids = frozenset(_to_id(id, "maintainers") for id in maintainers)
+        self.notify_ids = frozenset(_to_id(id, "maintainers") for id, info in maintainers.items() if info['notify_on_exception'])
+
+        # Optional, metrics are off unless configured
+        if 'metrics' in config:
+            metrics = _require(config, 'metrics', dict, "config")
+            self.metrics_enabled = _require(metrics, 'enabled', bool, "metrics")
+            self.metrics_host = metrics.get('host', self.metrics_host)
+            self.metrics_port = metrics.get('port', self.metrics_port)
+            if not isinstance(self.metrics_port, int) or not 0 < self.metrics_port < 65536:
+                raise InvalidConfigException(f"metrics.port must be a port number, got {self.metrics_port!r}")
+
+        # Optional, defaults to discord.py's usual behaviour of caching every member.
+        # Changing the mode only takes effect on restart.
+        if 'member_cache' in config:
+            member_cache = _require(config, 'member_cache', dict, "config")
+            self.member_cache_mode = _require(member_cache, 'mode', str, "member_cache")
+            if self.member_cache_mode not in ("full", "lazy"):
+                raise InvalidConfigException(f"member_cache.mode must be 'full' or 'lazy', got {self.member_cache_mode!r}")
+            self.member_cache_size = member_cache.get('max_members', self.member_cache_size)
+            if not isinstance(self.member_cache_size, int) or isinstance(self.member_cache_size, bool) or self.member_cache_size < 1:
+                raise InvalidConfigException(f"member_cache.max_members must be a positive integer, got {self.member_cache_size!r}")
+
+        # Optional, one gateway connection in one process unless configured
+        if 'sharding' in config:
+            sharding = _require(config, 'sharding', dict, "config")
+            self.sharding_enabled = _require(sharding, 'enabled', bool, "sharding")
+            # None lets Discord pick the shard count
+            self.shard_count = sharding.get('shard_count')
+            self.shard_processes = sharding.get('processes', 1)
+            for key, value in (('shard_count', self.shard_count), ('processes', self.shard_processes)):
+                if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 1):
+                    raise InvalidConfigException(f"sharding.{key} must be a positive integer, got {value!r}")
+            if self.shard_processes > 1:
+                if not self.sharding_enabled or self.shard_count is None:
+                    raise InvalidConfigException("sharding.processes above 1 needs sharding enabled and a fixed sharding.shard_count")
+                if self.shard_processes > self.shard_count:
+                    raise InvalidConfigException("sharding.processes can't be more than sharding.shard_count")
+
+        # Optional, archives Regulars and never prunes unless configured
+        if 'retention' in config:
+            retention = _require(config, 'retention', dict, "config")
+            self.maintenance_hours = retention.get('maintenance_hours', self.maintenance_hours)
+            self.archive_regulars = retention.get('archive_regulars', self.archive_regulars)
+            self.prune_departed_days = retention.get('prune_departed_days', self.prune_departed_days)
+            for key, value in (('maintenance_hours', self.maintenance_hours), ('prune_departed_days', self.prune_departed_days)):
+                if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0):
+                    raise InvalidConfigException(f"retention.{key} must be a positive number, got {value!r}")
+            if self.maintenance_hours is None:
+                raise InvalidConfigException("retention.maintenance_hours can't be null")
+            if not isinstance(self.archive_regulars, bool):
+                raise InvalidConfigException(f"retention.archive_regulars must be true or false, got {self.archive_regulars!r}")
+
+        # Optional, profiles go under db/ unless configured
+        if 'profiling' in config:
+            profiling = _require(config, 'profiling', dict, "config")
+            self.profile_dir = _require(profiling, 'output_dir', str, "profiling")
+
+        guilds = _require(config, 'guilds', dict, "config")
+        self.guilds = {}
+        for guild_key, guild_config in guilds.items():
+            policy = GuildPolicy.compile(guild_key, guild_config)
+            self.guilds[policy.guild_id] = policy
+
     def __getitem__(self, key):
         return self.settings.__getitem__(key)
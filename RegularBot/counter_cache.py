@@ -0,0 +1,205 @@
+"""
+Write-behind message counter cache for RegularBot.
+
+Message counts live in memory and are written out to the `users` table in
+batches, so counting a message doesn't cost a database commit.
+"""
+
+import asyncio
+from collections import OrderedDict
+from RegularBot.storage import RegularBotStorage
+
+# Flush as soon as this many users have unsaved counts, even if the timer
+# hasn't fired yet
+FLUSH_MAX_DIRTY = 500
+
+# Upper bound on how many users we keep in memory. Only entries that have
+# been written out are ever evicted.
+MAX_ENTRIES = 50000
+
+class CounterEntry:
+    """
+    Cached state of a single (guild, user) row. `pending` is the number of
+    counted messages that haven't been written to the database yet.
+    """
+    __slots__ = ("message_count", "encouraged", "congratulated", "pending", "dirty")
+
+    def __init__(self, message_count, encouraged, congratulated):
+        self.message_count = message_count
+        self.encouraged = encouraged
+        self.congratulated = congratulated
+        self.pending = 0
+        self.dirty = False
+
+class CounterResult:
+    """
+    Outcome of counting one message
+    """
+    __slots__ = ("message_count", "encourage", "congratulate", "give_role")
+
+    def __init__(self, message_count, encourage=False, congratulate=False, give_role=False):
+        self.message_count = message_count
+        self.encourage = encourage
+        self.congratulate = congratulate
+        self.give_role = give_role
+
+class MessageCounterCache:
+
+    def __init__(self, storage: RegularBotStorage, flush_max_dirty=FLUSH_MAX_DIRTY, max_entries=MAX_ENTRIES):
+        self.storage = storage
+        self.flush_max_dirty = flush_max_dirty
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple[int, int], CounterEntry] = OrderedDict()
+        self.dirty: set[tuple[int, int]] = set()
+        # Serializes flushes so a new row can't be inserted twice
+        self.flush_lock = asyncio.Lock()
+
+    async def _load(self, key):
+        """
+        Read a user's row from the database, or make a fresh entry if they've never been seen
+        """
+        guild_id, user_id = key
+        db_user = await self.storage.get_user(guild_id, user_id)
+        if db_user:
+            return CounterEntry(db_user[0], bool(db_user[1]), bool(db_user[2]))
+        return CounterEntry(0, False, False)
+
+    async def get(self, guild_id, user_id):
+        key = (guild_id, user_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            loaded = await self._load(key)
+            # Another message from the same user may have loaded the entry
+            # while we were waiting on the database; theirs wins
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = loaded
+                self.entries[key] = entry
+        else:
+            self.entries.move_to_end(key)
+        return entry
+
+    async def read_count(self, guild_id, user_id):
+        """
+        A user's current message count, including anything not flushed yet.
+        Never waits on writes, and doesn't add the user to the cache.
+        """
+        entry = self.entries.get((guild_id, user_id))
+        if entry is not None:
+            return entry.message_count
+        # Entries are only evicted once they're written out, so the database is current for this user
+        db_user = await self.storage.get_user(guild_id, user_id)
+        return db_user[0] if db_user else 0
+
+    async def record_message(self, guild_id, user_id, threshold) -> CounterResult:
+        """
+        Count one message and work out whether the user has crossed the
+        halfway or full threshold. Nothing is written to disk here.
+        """
+        key = (guild_id, user_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            # Cold user: count the message and load their row in one upsert
+            db_user = await self.storage.increment_user(guild_id, user_id)
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = CounterEntry(db_user[0], bool(db_user[1]), bool(db_user[2]))
+                self.entries[key] = entry
+            else:
+                # Somebody else loaded them while we waited, from before or after
+                # our upsert landed. The database count already includes our
+                # message, so take whichever is further along rather than adding it again.
+                entry.message_count = max(entry.message_count, db_user[0])
+        else:
+            self.entries.move_to_end(key)
+            entry.message_count += 1
+            entry.pending += 1
+            entry.dirty = True
+            self.dirty.add(key)
+
+        result = CounterResult(entry.message_count)
+        if entry.message_count >= threshold:
+            # only send the message if they haven't gotten it already
+            # if the message was sent before but role assignment failed for some reason,
+            # this stops us from spamming the user while still reattempting role assignment
+            if not entry.congratulated:
+                entry.congratulated = True
+                result.congratulate = True
+            result.give_role = True
+        elif entry.message_count >= (threshold / 2) and not entry.encouraged:
+            entry.encouraged = True
+            result.encourage = True
+
+        if result.congratulate or result.encourage:
+            entry.dirty = True
+            self.dirty.add(key)
+
+        return result
+
+    def apply_external_counts(self, guild_id, counts):
+        """
+        Keep cached totals in line with counts that were written straight to
+        the database (e.g. by a backfill). Users who aren't cached will pick
+        the new totals up when they're next loaded.
+        """
+        for user_id, count in counts.items():
+            entry = self.entries.get((guild_id, user_id))
+            if entry is not None:
+                entry.message_count += count
+
+    def forget(self, guild_id, user_id):
+        """
+        Drop a user whose row was deleted, unless they have counts waiting to be written
+        """
+        key = (guild_id, user_id)
+        entry = self.entries.get(key)
+        if entry is not None and not entry.dirty:
+            del self.entries[key]
+
+    def needs_flush(self):
+        return len(self.dirty) >= self.flush_max_dirty
+
+    async def flush(self):
+        """
+        Write every dirty entry out in a single transaction. Returns the number of rows written.
+        """
+        async with self.flush_lock:
+            if not self.dirty:
+                return 0
+
+            # Snapshot the dirty entries and mark them clean up front. Anything
+            # counted while the write is in flight dirties the entry again.
+            keys = list(self.dirty)
+            self.dirty.clear()
+            rows = []
+            for key in keys:
+                entry = self.entries[key]
+                entry.dirty = False
+                guild_id, user_id = key
+                rows.append((guild_id, user_id, entry.pending, entry.encouraged, entry.congratulated))
+
+            try:
+                await self.storage.add_users(rows)
+            except BaseException:
+                # Put everything back so the next flush retries it
+                for key in keys:
+                    self.entries[key].dirty = True
+                self.dirty.update(keys)
+                raise
+
+            # Only take off what we actually wrote, in case more came in meanwhile
+            for (guild_id, user_id, written, _, _) in rows:
+                self.entries[(guild_id, user_id)].pending -= written
+
+            self._evict()
+            return len(keys)
+
+    def _evict(self):
+        # Drop the least recently used clean entries once we're over capacity
+        while len(self.entries) > self.max_entries:
+            for key, entry in self.entries.items():
+                if not entry.dirty:
+                    del self.entries[key]
+                    break
+            else:
+                return
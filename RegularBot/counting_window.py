@@ -0,0 +1,87 @@
+"""
+Per-user counting limits for RegularBot.
+
+A guild can cap how many of a user's messages count towards the Regular
+role: at most N in any window of W seconds. Each active user keeps the times
+of their last N counted messages, and a message only counts if the oldest of
+those is at least W seconds old. Messages that don't count are dropped before
+they reach the counter cache, the locks or the database. So a user flooding a
+channel costs a dict lookup per message, and spamming is no shortcut to the
+role.
+
+A window whose newest message is W seconds old no longer limits anything,
+which is the same as not having one, so those are thrown away.
+"""
+
+import time
+from collections import OrderedDict, deque
+from RegularBot import metrics
+from RegularBot.config import GuildPolicy
+
+MESSAGES_OVER_LIMIT = metrics.counter("regularbot_messages_over_limit_total", "Messages not counted because the user hit their guild's count_limit")
+
+# Hard cap on windows, in case a raid brings in more users than idle eviction can keep up with
+MAX_WINDOWS = 100000
+
+class SlidingWindow:
+    """
+    When a user's last `messages` counted messages were sent
+    """
+    __slots__ = ("times", "seconds")
+
+    def __init__(self, messages, seconds):
+        self.times = deque(maxlen=messages)
+        self.seconds = seconds
+
+    def try_count(self, now):
+        """
+        Counts a message sent at `now` if that keeps the window under its limit
+        """
+        times = self.times
+        if len(times) == times.maxlen and now - times[0] < self.seconds:
+            return False
+        # Full deques drop the oldest time, which has just left the window
+        times.append(now)
+        return True
+
+class CountingWindows:
+
+    def __init__(self, max_windows=MAX_WINDOWS):
+        self.max_windows = max_windows
+        # (guild_id, user_id) -> window, least recently active first
+        self.windows: OrderedDict[tuple[int, int], SlidingWindow] = OrderedDict()
+
+    def allow(self, policy: GuildPolicy, user_id):
+        """
+        Whether this message counts. Takes up one of the user's messages in the window if it does.
+        """
+        if policy.count_limit is None:
+            return True
+        messages, seconds = policy.count_limit
+
+        now = time.monotonic()
+        key = (policy.guild_id, user_id)
+        window = self.windows.get(key)
+        if window is None:
+            self._evict(now)
+            window = SlidingWindow(messages, seconds)
+            self.windows[key] = window
+        else:
+            self.windows.move_to_end(key)
+            # The limit may have changed with a config reload
+            if window.times.maxlen != messages:
+                window.times = deque(window.times, maxlen=messages)
+            window.seconds = seconds
+
+        if window.try_count(now):
+            return True
+        MESSAGES_OVER_LIMIT.inc()
+        return False
+
+    def _evict(self, now):
+        # Oldest first; stop at the first one that still limits anything
+        while self.windows:
+            key, window = next(iter(self.windows.items()))
+            if now - window.times[-1] < window.seconds and len(self.windows) < self.max_windows:
+                return
+            del self.windows[key]
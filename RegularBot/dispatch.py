@@ -0,0 +1,312 @@
+"""
+Background dispatch of Discord REST work for RegularBot.
+
+Replies and role grants are queued instead of being awaited in on_message, so
+REST latency and rate limit back-offs don't hold up message handling. A few
+workers drain the queue, each guild gets its own rate limit bucket, and
+failed jobs are retried with exponential backoff.
+
+Jobs only hold IDs, never discord.py objects, so they can be re-resolved
+against whichever client is running them.
+"""
+
+import asyncio
+import random
+import time
+from collections import deque
+import discord
+from RegularBot import metrics
+
+# Number of jobs that can be talking to Discord at once
+WORKERS = 4
+# Jobs beyond this are dropped rather than letting the queue grow forever
+MAX_QUEUE_SIZE = 10000
+# Per-guild bucket: sustained requests per second, and how many can go at once
+GUILD_RATE = 5.0
+GUILD_BURST = 10
+# Retry schedule, doubling from the base delay up to the max
+MAX_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 60.0
+# Buckets for guilds we haven't sent anything to in this long are thrown away
+BUCKET_IDLE_SECONDS = 600
+
+REST_SECONDS = metrics.histogram("regularbot_rest_seconds", "Time taken by each REST job attempt, by job kind")
+DISPATCH_SECONDS = metrics.histogram("regularbot_dispatch_seconds", "Time from a job being queued until it succeeded or was given up on")
+DISPATCH_RESULTS = metrics.counter("regularbot_dispatch_jobs_total", "Jobs by outcome")
+DISPATCH_DEPTH = metrics.gauge("regularbot_dispatch_queue_depth", "Jobs queued, waiting to retry, or carried over")
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, now=None):
+        """
+        Takes a token if there is one, without waiting
+        """
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class DispatchJob:
+    """
+    Base class for queued REST work. `key` identifies jobs that would do the
+    same thing, so duplicates can be dropped while one is still pending.
+    """
+    kind = "job"
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+
+    @property
+    def key(self):
+        return None
+
+    async def run(self, client: discord.Client):
+        raise NotImplementedError
+
+class ReplyJob(DispatchJob):
+    kind = "reply"
+
+    def __init__(self, guild_id, channel_id, message_id, text):
+        super().__init__(guild_id)
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.text = text
+
+    async def run(self, client: discord.Client):
+        channel = client.get_channel(self.channel_id) or await client.fetch_channel(self.channel_id)
+        await channel.get_partial_message(self.message_id).reply(self.text)
+
+class RoleGrantJob(DispatchJob):
+    kind = "grant"
+
+    def __init__(self, guild_id, member_id, role_id):
+        super().__init__(guild_id)
+        self.member_id = member_id
+        self.role_id = role_id
+
+    @property
+    def key(self):
+        return ("grant", self.guild_id, self.member_id, self.role_id)
+
+    async def run(self, client: discord.Client):
+        guild = client.get_guild(self.guild_id)
+        if guild is None:
+            raise LookupError(f"Not in guild {self.guild_id}")
+
+        role = guild.get_role(self.role_id)
+        if role is None:
+            raise LookupError(f"Can't find role {self.role_id}.\nAvailable roles: {[r for r in guild.roles]}")
+
+        member = await client.members.resolve(guild, self.member_id)
+        # They've left the guild, nothing to do
+        if member is None or member.get_role(self.role_id):
+            return
+        await member.add_roles(role)
+
+class DispatchStats:
+    __slots__ = ("enqueued", "deduplicated", "dropped", "completed", "retried", "failed", "latency_total", "latency_max")
+
+    def __init__(self):
+        self.enqueued = 0
+        self.deduplicated = 0
+        self.dropped = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def record_latency(self, latency):
+        self.latency_total += latency
+        if latency > self.latency_max:
+            self.latency_max = latency
+
+class DispatchQueue:
+
+    def __init__(self, workers=WORKERS, max_queue_size=MAX_QUEUE_SIZE, on_give_up=None):
+        self.worker_count = workers
+        # Called with (job, exception) when a job fails for good
+        self.on_give_up = on_give_up
+        self.max_queue_size = max_queue_size
+        self.client = None
+        self.stats = DispatchStats()
+        # Keys of jobs that are queued, running, or waiting to retry
+        self.pending_keys: set = set()
+        self.buckets: dict[int, TokenBucket] = {}
+        # Jobs carried over while no client is running
+        self.backlog: deque[DispatchJob] = deque()
+        self._queue: asyncio.Queue | None = None
+        self._workers: list[asyncio.Task] = []
+        self._retries: set[asyncio.Task] = set()
+
+    @property
+    def depth(self):
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return queued + len(self.backlog) + len(self._retries)
+
+    def start(self, client: discord.Client):
+        """
+        Start the workers on the running loop. Anything left over from a previous run goes first.
+        """
+        self.client = client
+        DISPATCH_DEPTH.func = lambda: self.depth
+        self._queue = asyncio.Queue()
+        while self.backlog:
+            self._queue.put_nowait(self.backlog.popleft())
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        """
+        Stop the workers and keep whatever hadn't been sent yet in the backlog
+        """
+        tasks = self._workers + list(self._retries)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._retries.clear()
+        if self._queue is not None:
+            while not self._queue.empty():
+                self.backlog.append(self._queue.get_nowait())
+        self._queue = None
+
+    def enqueue(self, job: DispatchJob):
+        key = job.key
+        if key is not None:
+            if key in self.pending_keys:
+                self.stats.deduplicated += 1
+                DISPATCH_RESULTS.child("result", "deduplicated").inc()
+                return False
+        if self.depth >= self.max_queue_size:
+            self.stats.dropped += 1
+            DISPATCH_RESULTS.child("result", "dropped").inc()
+            print(f"dispatch queue full, dropping {job.kind} for guild {job.guild_id}")
+            return False
+
+        if key is not None:
+            self.pending_keys.add(key)
+        self.stats.enqueued += 1
+        if self._queue is None:
+            self.backlog.append(job)
+        else:
+            self._queue.put_nowait(job)
+        return True
+
+    async def throttle(self, guild_id):
+        """
+        Waits for a token from the guild's bucket, so REST calls made outside
+        the queue share its budget with the queued jobs
+        """
+        await self._bucket(guild_id).acquire()
+
+    def _bucket(self, guild_id):
+        bucket = self.buckets.get(guild_id)
+        if bucket is None:
+            now = time.monotonic()
+            # Clean out idle guilds whenever a new one shows up
+            for idle_id in [id for id, b in self.buckets.items() if now - b.updated > BUCKET_IDLE_SECONDS]:
+                del self.buckets[idle_id]
+            bucket = TokenBucket(GUILD_RATE, GUILD_BURST)
+            self.buckets[guild_id] = bucket
+        return bucket
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._bucket(job.guild_id).acquire()
+            except asyncio.CancelledError:
+                self.backlog.append(job)
+                raise
+            await self._run(job)
+
+    async def _run(self, job: DispatchJob):
+        job.attempts += 1
+        start = time.perf_counter()
+        try:
+            try:
+                await job.run(self.client)
+            finally:
+                REST_SECONDS.child("kind", job.kind).observe(time.perf_counter() - start)
+        except asyncio.CancelledError:
+            # Shutting down mid-request; try it again next time
+            job.attempts -= 1
+            self.backlog.append(job)
+            raise
+        except (discord.Forbidden, discord.NotFound, LookupError) as e:
+            # Retrying won't fix these
+            self._give_up(job, e)
+        except Exception as e:
+            # Nor any other 4xx, e.g. replying to a message that's since been
+            # deleted, which Discord rejects as a 400 rather than a 404
+            rejected = isinstance(e, discord.HTTPException) and e.status < 500
+            if rejected or job.attempts >= MAX_ATTEMPTS:
+                self._give_up(job, e)
+                return
+            self.stats.retried += 1
+            DISPATCH_RESULTS.child("result", "retried").inc()
+            delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (job.attempts - 1))
+            delay *= random.uniform(0.5, 1.0)
+            task = asyncio.create_task(self._retry_later(job, delay))
+            self._retries.add(task)
+            task.add_done_callback(self._retries.discard)
+        else:
+            self._finish(job, ok=True)
+
+    async def _retry_later(self, job: DispatchJob, delay):
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.backlog.append(job)
+            raise
+        self._queue.put_nowait(job)
+
+    def _give_up(self, job: DispatchJob, exc):
+        self._finish(job, ok=False)
+        print(f"giving up on {job.kind} for guild {job.guild_id} after {job.attempts} attempt(s): {exc}")
+        if self.on_give_up:
+            self.on_give_up(job, exc)
+
+    def _finish(self, job: DispatchJob, ok):
+        if job.key is not None:
+            self.pending_keys.discard(job.key)
+        if ok:
+            self.stats.completed += 1
+            DISPATCH_RESULTS.child("result", "completed").inc()
+        else:
+            self.stats.failed += 1
+            DISPATCH_RESULTS.child("result", "failed").inc()
+        latency = time.monotonic() - job.enqueued_at
+        self.stats.record_latency(latency)
+        DISPATCH_SECONDS.observe(latency)
+
+    def __str__(self):
+        done = self.stats.completed + self.stats.failed
+        avg_ms = (self.stats.latency_total / done * 1000) if done else 0.0
+        return (f"depth {self.depth}, {self.stats.completed} done, {self.stats.failed} failed, "
+                f"{self.stats.retried} retried, {self.stats.deduplicated} deduplicated, {self.stats.dropped} dropped, "
+                f"avg latency {avg_ms:.1f}ms, max latency {self.stats.latency_max * 1000:.1f}ms")
@@ -0,0 +1,151 @@
+"""
+Error reporting for RegularBot.
+
+Errors are fingerprinted by type, message and where they happened, and
+repeats are only counted. Every ERROR_DIGEST_SECONDS the client sends the
+maintainers one digest covering everything since the last one: the full
+traceback for errors they haven't seen before, and a count for the rest. An
+error that fires on every message costs one line per digest, not one DM per
+message, and the number of errors tracked is capped.
+"""
+
+import hashlib
+import time
+import traceback
+from collections import OrderedDict
+from RegularBot import metrics
+from RegularBot.outbox import MAX_MESSAGE_LENGTH
+
+ERRORS_REPORTED = metrics.counter("regularbot_errors_total", "Errors reported to the maintainers' digest")
+ERRORS_DROPPED = metrics.counter("regularbot_errors_dropped_total", "Errors that couldn't be tracked because too many distinct errors were pending")
+
+# How often a digest goes out, if there's anything in it
+ERROR_DIGEST_SECONDS = 60
+# Distinct errors tracked at once
+MAX_DISTINCT_ERRORS = 200
+# Messages per digest; whatever doesn't fit is summed up in the last line
+MAX_DIGEST_MESSAGES = 5
+# Room left for a traceback in a digest, so a few still fit in one message
+MAX_DETAILS_LENGTH = 1500
+
+def _frames(exc: BaseException, skip):
+    if exc.__traceback__ is not None:
+        return traceback.extract_tb(exc.__traceback__)
+    # Never raised (RegularBotException reports itself when it's created), so use where it was made
+    return traceback.extract_stack()[:-(skip + 1)]
+
+def fingerprint(exc: BaseException, frames):
+    """
+    Errors with the same type, message and stack are the same error
+    """
+    key = repr((type(exc).__qualname__, str(exc), [(f.filename, f.name, f.lineno) for f in frames]))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def _details(exc: BaseException, frames):
+    if exc.__traceback__ is not None:
+        text = "".join(traceback.format_exception(exc))
+    else:
+        text = "Traceback (most recent call last):\n" + "".join(traceback.format_list(frames)) + "".join(traceback.format_exception_only(exc))
+    if len(text) > MAX_DETAILS_LENGTH:
+        text = "..." + text[-(MAX_DETAILS_LENGTH - 3):]
+    return text
+
+class ErrorRecord:
+    __slots__ = ("summary", "details", "count", "unreported", "reported", "first_seen", "last_seen")
+
+    def __init__(self, exc, frames):
+        self.summary = "".join(traceback.format_exception_only(exc)).strip()
+        self.details = _details(exc, frames)
+        self.count = 0
+        # Occurrences since the last digest that went out
+        self.unreported = 0
+        # Whether the maintainers have had the full traceback yet
+        self.reported = False
+        self.first_seen = time.time()
+        self.last_seen = self.first_seen
+
+class ExceptionAggregator:
+
+    def __init__(self, max_errors=MAX_DISTINCT_ERRORS):
+        self.max_errors = max_errors
+        self.records: OrderedDict[str, ErrorRecord] = OrderedDict()
+        # Reports we had no room to track since the last digest
+        self.dropped = 0
+
+    def report(self, exc: BaseException):
+        # Leave out this frame when there's no traceback to use
+        frames = _frames(exc, skip=1)
+        key = fingerprint(exc, frames)
+        record = self.records.get(key)
+        if record is None:
+            if len(self.records) >= self.max_errors and not self._evict():
+                self.dropped += 1
+                ERRORS_DROPPED.inc()
+                return
+            record = ErrorRecord(exc, frames)
+            self.records[key] = record
+        else:
+            self.records.move_to_end(key)
+        record.count += 1
+        record.unreported += 1
+        record.last_seen = time.time()
+        ERRORS_REPORTED.inc()
+
+    def _evict(self):
+        # Forget the stalest error that's already been fully reported
+        for key, record in self.records.items():
+            if not record.unreported:
+                del self.records[key]
+                return True
+        return False
+
+    def digest(self):
+        """
+        Returns (messages, snapshot) for everything since the last digest. Call
+        mark_sent(snapshot) once it's been delivered; until then the same
+        errors keep adding up for the next digest.
+        """
+        pending = [(key, record, record.unreported) for key, record in self.records.items() if record.unreported]
+        if not pending and not self.dropped:
+            return [], None
+
+        total = sum(unreported for _, _, unreported in pending) + self.dropped
+        messages = []
+        current = f"**{total} error(s) since the last report, {len(pending)} distinct**"
+        included = []
+        for key, record, unreported in pending:
+            if record.reported:
+                entry = f"`{record.summary[:200]}` x{unreported} ({record.count} total)"
+            else:
+                entry = f"x{unreported}:\n```{record.details}```"
+            if len(current) + len(entry) + 1 > MAX_MESSAGE_LENGTH:
+                if len(messages) + 1 >= MAX_DIGEST_MESSAGES:
+                    break
+                messages.append(current)
+                current = ""
+            current = f"{current}\n{entry}" if current else entry
+            included.append((key, unreported))
+
+        skipped = len(pending) - len(included)
+        footer = ""
+        if skipped:
+            footer += f"\n...and {skipped} more distinct error(s) that didn't fit"
+        if self.dropped:
+            footer += f"\n{self.dropped} error(s) weren't tracked because too many distinct errors were pending"
+        if footer:
+            if len(current) + len(footer) > MAX_MESSAGE_LENGTH:
+                messages.append(current)
+                current = footer.lstrip("\n")
+            else:
+                current += footer
+        messages.append(current)
+        return messages, (included, self.dropped)
+
+    def mark_sent(self, snapshot):
+        included, dropped = snapshot
+        for key, unreported in included:
+            record = self.records.get(key)
+            if record is not None:
+                record.unreported -= unreported
+                record.reported = True
+        self.dropped -= dropped
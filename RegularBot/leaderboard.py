@@ -0,0 +1,249 @@
+"""
+Per-guild leaderboards for RegularBot.
+
+Each guild has two boards, kept in memory and updated as messages are
+counted:
+ - "top": the users with the most counted messages
+ - "progress": the users closest to the Regular role who don't have it yet
+
+A board holds the top BOARD_CAPACITY users. Offering it a count that doesn't
+make the cut is a dict lookup and a comparison, so it's cheap enough to do on
+every message, and reading a board never touches SQLite. Boards are saved
+alongside the message counts in a packed form and loaded at startup.
+
+Each board also keeps a floor: the highest count of anyone who belongs on it
+but was turned away or pushed off. Everyone counted above the floor is on the
+board, and counts only go up, so a board stays exact on its own. Users leaving
+the progress board by crossing the threshold take nothing from the rest of it;
+it only needs rebuilding from the users table once fewer than DISPLAY_SIZE of
+its users are above the floor. A backfill or a threshold change always marks
+the guild stale, and its boards are rebuilt on the next flush.
+"""
+
+from array import array
+from RegularBot.config import GuildPolicy
+
+# Users kept per board; more than are shown, so a board still has plenty to show while it's waiting to be rebuilt
+BOARD_CAPACITY = 50
+# Users shown by /rbleaderboard and progress reports
+DISPLAY_SIZE = 10
+# The "top" board has no upper limit on counts
+NO_LIMIT = 2 ** 62
+# The floor of a board nobody's been left off
+NO_FLOOR = -1
+
+TOP = "top"
+PROGRESS = "progress"
+
+class TopK:
+    __slots__ = ("capacity", "counts", "min_user", "floor")
+
+    def __init__(self, capacity=BOARD_CAPACITY, entries=(), floor=NO_FLOOR):
+        self.capacity = capacity
+        self.counts: dict[int, int] = {}
+        self.min_user = None
+        self.floor = NO_FLOOR
+        for user_id, count in entries:
+            self.offer(user_id, count)
+        # Set after the entries, which may well be at the floor themselves
+        self.floor = max(self.floor, floor)
+
+    def _find_min(self):
+        self.min_user = min(self.counts, key=self.counts.__getitem__) if self.counts else None
+
+    def offer(self, user_id, count):
+        """
+        Puts the user on the board if their count makes the cut. Returns whether the board changed.
+        """
+        counts = self.counts
+        if user_id in counts:
+            if counts[user_id] == count:
+                return False
+            counts[user_id] = count
+            if user_id == self.min_user:
+                self._find_min()
+            return True
+        if count <= self.floor:
+            # Somebody who isn't on the board may have more; letting this one
+            # in would put a count on the board that isn't known to be in the top
+            return False
+        if len(counts) < self.capacity:
+            counts[user_id] = count
+            if self.min_user is None or count < counts[self.min_user]:
+                self.min_user = user_id
+            return True
+        if count <= counts[self.min_user]:
+            self.floor = count
+            return False
+        self.floor = max(self.floor, counts.pop(self.min_user))
+        counts[user_id] = count
+        self._find_min()
+        return True
+
+    def remove(self, user_id):
+        if self.counts.pop(user_id, None) is None:
+            return False
+        if user_id == self.min_user:
+            self._find_min()
+        return True
+
+    def complete(self, n=DISPLAY_SIZE):
+        """
+        Whether the board's top n are everyone's top n
+        """
+        if self.floor == NO_FLOOR:
+            return True
+        return sum(count > self.floor for count in self.counts.values()) >= n
+
+    def top(self, n=DISPLAY_SIZE):
+        """
+        [(user_id, count)], highest first
+        """
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+    def pack(self):
+        packed = array("q")
+        for user_id, count in self.counts.items():
+            packed.append(user_id)
+            packed.append(count)
+        return packed.tobytes()
+
+    @classmethod
+    def unpack(cls, data, floor, capacity=BOARD_CAPACITY):
+        packed = array("q")
+        packed.frombytes(data)
+        return cls(capacity, zip(packed[0::2], packed[1::2]), floor)
+
+    @classmethod
+    def from_database(cls, rows, capacity=BOARD_CAPACITY):
+        """
+        A board of the top `capacity` counts from the users table, highest first
+        """
+        # A full page may have left out users tied with the last one
+        return cls(capacity, rows, rows[-1][1] if len(rows) >= capacity else NO_FLOOR)
+
+class GuildLeaderboards:
+
+    def __init__(self, storage, capacity=BOARD_CAPACITY):
+        self.storage = storage
+        self.capacity = capacity
+        # (guild_id, board) -> TopK
+        self.boards: dict[tuple[int, str], TopK] = {}
+        # The threshold each guild's progress board was built for
+        self.thresholds: dict[int, int] = {}
+        # Boards changed since they were last saved
+        self.dirty: set[tuple[int, str]] = set()
+        # Guilds whose boards need rebuilding from the users table
+        self.stale: set[int] = set()
+
+    async def load(self):
+        for guild_id, board, threshold, entries, floor in await self.storage.get_leaderboards():
+            if floor is None:
+                # Saved before boards kept a floor, so there's no telling who's missing
+                self.stale.add(guild_id)
+                floor = NO_FLOOR
+            self.boards[(guild_id, board)] = TopK.unpack(entries, floor, self.capacity)
+            if board == PROGRESS:
+                self.thresholds[guild_id] = threshold
+
+    def _board(self, guild_id, board):
+        key = (guild_id, board)
+        top_k = self.boards.get(key)
+        if top_k is None:
+            top_k = TopK(self.capacity)
+            self.boards[key] = top_k
+            # Nothing saved for this guild, so fill it from the database
+            self.stale.add(guild_id)
+        return top_k
+
+    def record(self, guild_id, user_id, message_count, threshold):
+        """
+        Called with a user's new count every time a message of theirs is counted
+        """
+        if self._board(guild_id, TOP).offer(user_id, message_count):
+            self.dirty.add((guild_id, TOP))
+
+        progress = self._board(guild_id, PROGRESS)
+        if message_count < threshold:
+            if progress.offer(user_id, message_count):
+                self.dirty.add((guild_id, PROGRESS))
+        elif progress.remove(user_id):
+            self.dirty.add((guild_id, PROGRESS))
+            # Everyone else above the floor is still on the board, so only
+            # go to the database once there aren't enough of them to show
+            if not progress.complete():
+                self.stale.add(guild_id)
+
+    def invalidate(self, guild_id):
+        """
+        Counts changed some other way (e.g. a backfill), so rebuild on the next refresh
+        """
+        self.stale.add(guild_id)
+
+    def forget(self, guild_id, user_ids):
+        """
+        Take users whose rows were deleted off the guild's boards, and refill
+        them on the next refresh if that leaves too few to show
+        """
+        for board in (TOP, PROGRESS):
+            top_k = self.boards.get((guild_id, board))
+            if top_k is None:
+                continue
+            for user_id in user_ids:
+                if top_k.remove(user_id):
+                    self.dirty.add((guild_id, board))
+            if not top_k.complete():
+                self.stale.add(guild_id)
+
+    def top(self, guild_id, n=DISPLAY_SIZE):
+        board = self.boards.get((guild_id, TOP))
+        return board.top(n) if board else []
+
+    def closest(self, policy: GuildPolicy, n=DISPLAY_SIZE):
+        """
+        The users closest to the Regular role, as [(user_id, count)]
+        """
+        if self.thresholds.get(policy.guild_id, policy.message_threshold) != policy.message_threshold:
+            self.stale.add(policy.guild_id)
+        board = self.boards.get((policy.guild_id, PROGRESS))
+        if board is None:
+            return []
+        # The threshold may have just dropped; don't list anyone who's already over it
+        return [(user_id, count) for user_id, count in board.top(self.capacity) if count < policy.message_threshold][:n]
+
+    async def refresh(self, policies):
+        """
+        Rebuilds stale boards from the users table, then saves whatever changed.
+        Counts should have just been flushed, so the table is up to date.
+        """
+        for policy in policies:
+            guild_id = policy.guild_id
+            if self.thresholds.get(guild_id) not in (None, policy.message_threshold):
+                self.stale.add(guild_id)
+            if guild_id not in self.stale:
+                continue
+            self.stale.discard(guild_id)
+
+            top = TopK.from_database(await self.storage.get_top_users(guild_id, NO_LIMIT, self.capacity), self.capacity)
+            progress = TopK.from_database(await self.storage.get_top_users(guild_id, policy.message_threshold, self.capacity), self.capacity)
+            # Keep anything counted in memory since, which the table may not have yet
+            for user_id, count in self.boards.get((guild_id, TOP), TopK(0)).counts.items():
+                top.offer(user_id, max(count, top.counts.get(user_id, 0)))
+            for user_id, count in self.boards.get((guild_id, PROGRESS), TopK(0)).counts.items():
+                if count < policy.message_threshold:
+                    progress.offer(user_id, max(count, progress.counts.get(user_id, 0)))
+
+            self.boards[(guild_id, TOP)] = top
+            self.boards[(guild_id, PROGRESS)] = progress
+            self.thresholds[guild_id] = policy.message_threshold
+            self.dirty.update(((guild_id, TOP), (guild_id, PROGRESS)))
+
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        rows = [(guild_id, board, self.thresholds.get(guild_id, 0), self.boards[(guild_id, board)].pack(), self.boards[(guild_id, board)].floor) for guild_id, board in dirty]
+        try:
+            await self.storage.save_leaderboards(rows)
+        except BaseException:
+            self.dirty |= dirty
+            raise
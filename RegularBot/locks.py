@@ -0,0 +1,93 @@
+"""
+Per-key asyncio locks for RegularBot.
+
+Work for different users runs concurrently, while work for the same user is
+serialized. The table only keeps locks that are in use or were used recently,
+so it doesn't grow with the number of users the bot has ever seen.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from RegularBot import metrics
+
+LOCK_WAIT_SECONDS = metrics.histogram("regularbot_lock_wait_seconds", "Time spent waiting for a per-user lock")
+LOCK_CONTENDED = metrics.counter("regularbot_lock_contended_total", "Lock acquisitions that had to wait for another holder")
+
+# Idle locks kept around before the least recently used are dropped
+MAX_IDLE_LOCKS = 4096
+
+class _KeyedLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        # Tasks holding or waiting on the lock. Only entries with no users can be evicted.
+        self.users = 0
+
+class LockStats:
+    """
+    Running totals of how long tasks waited to get a lock
+    """
+    __slots__ = ("acquisitions", "contended", "wait_total", "wait_max")
+
+    def __init__(self):
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, waited, contended):
+        self.acquisitions += 1
+        LOCK_WAIT_SECONDS.observe(waited)
+        if contended:
+            self.contended += 1
+            LOCK_CONTENDED.inc()
+        self.wait_total += waited
+        if waited > self.wait_max:
+            self.wait_max = waited
+
+    def __str__(self):
+        avg_ms = (self.wait_total / self.acquisitions * 1000) if self.acquisitions else 0.0
+        return (f"{self.acquisitions} acquisitions, {self.contended} contended, "
+                f"avg wait {avg_ms:.3f}ms, max wait {self.wait_max * 1000:.3f}ms")
+
+class KeyedLockTable:
+
+    def __init__(self, max_idle=MAX_IDLE_LOCKS):
+        self.max_idle = max_idle
+        self.locks: OrderedDict[object, _KeyedLock] = OrderedDict()
+        self.stats = LockStats()
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = _KeyedLock()
+            self.locks[key] = entry
+        else:
+            self.locks.move_to_end(key)
+
+        entry.users += 1
+        try:
+            contended = entry.lock.locked()
+            start = time.perf_counter()
+            await entry.lock.acquire()
+            self.stats.record(time.perf_counter() - start, contended)
+            try:
+                yield
+            finally:
+                entry.lock.release()
+        finally:
+            entry.users -= 1
+            if len(self.locks) > self.max_idle:
+                self._evict()
+
+    def _evict(self):
+        # Oldest first; anything still in use stays no matter how old it is
+        for key in list(self.locks):
+            if len(self.locks) <= self.max_idle:
+                return
+            if self.locks[key].users == 0:
+                del self.locks[key]
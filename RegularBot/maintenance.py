@@ -0,0 +1,172 @@
+"""
+Database upkeep for RegularBot.
+
+Runs once per maintenance interval, off the message path:
+ - Regulars confirmed to have the role are moved out of the users table into
+   users_archive. Nothing about them changes any more, so this keeps the table
+   every message touches (and its share of the page cache) down to the users
+   still working towards the role. The archive is transparent: reads fall back
+   to it, and a user is moved back as soon as anything is counted for them.
+ - Members who left a guild more than the grace period ago are pruned.
+ - Freed pages are given back to the filesystem a few at a time with
+   incremental vacuum, and the query planner's statistics are refreshed.
+   Databases created before incremental vacuum was turned on need one full
+   rebuild first, which blocks every write while it runs, so that's only
+   ever done when a maintainer asks for it with /rbmaintain.
+
+Every step is its own storage call, so counter flushes only ever wait behind
+one step, never the whole job.
+"""
+
+import time
+import discord
+from RegularBot import metrics
+from RegularBot.config import GuildPolicy
+from RegularBot.counter_cache import MessageCounterCache
+from RegularBot.dispatch import DispatchQueue
+from RegularBot.leaderboard import GuildLeaderboards
+from RegularBot.members import MemberCache, FULL
+from RegularBot.storage import RegularBotStorage
+
+ROWS_ARCHIVED = metrics.counter("regularbot_rows_archived_total", "Users moved into the archive by maintenance")
+ROWS_PRUNED = metrics.counter("regularbot_rows_pruned_total", "Rows deleted for members who left a guild")
+BYTES_RECLAIMED = metrics.counter("regularbot_bytes_reclaimed_total", "Bytes the database shrank by during maintenance")
+
+# Rows read or deleted per storage call
+MAINTENANCE_BATCH = 500
+# Free pages handed back per storage call
+VACUUM_STEP_PAGES = 1000
+
+class MaintenanceReport:
+    __slots__ = ("archived", "departed", "pruned", "bytes_before", "bytes_after", "rebuilt")
+
+    def __init__(self):
+        self.archived = 0
+        self.departed = 0
+        self.pruned = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+        # Whether the database had to be rebuilt to turn on incremental vacuum
+        self.rebuilt = False
+
+    @property
+    def bytes_reclaimed(self):
+        return max(0, self.bytes_before - self.bytes_after)
+
+    def __str__(self):
+        summary = (
+            f"{self.archived} Regulars archived, {self.departed} departures noted, {self.pruned} rows pruned, "
+            f"{self.bytes_reclaimed / 1024:.1f} KiB reclaimed ({self.bytes_before / 1024:.1f} -> {self.bytes_after / 1024:.1f} KiB)"
+        )
+        if self.rebuilt:
+            summary += ", rebuilt for incremental vacuum"
+        return summary
+
+class DatabaseMaintenance:
+
+    def __init__(self, storage: RegularBotStorage, counter_cache: MessageCounterCache, leaderboards: GuildLeaderboards, members: MemberCache, dispatch_queue: DispatchQueue):
+        self.storage = storage
+        self.counter_cache = counter_cache
+        self.leaderboards = leaderboards
+        self.members = members
+        self.dispatch_queue = dispatch_queue
+
+    async def run(self, guilds, archive=True, prune_after_seconds=None, compact=True, rebuild=False) -> MaintenanceReport:
+        """
+        guilds is [(discord.Guild or None, GuildPolicy)] for the guilds this
+        process owns. Pruning is skipped when prune_after_seconds is None.
+        compact vacuums and analyzes the whole database; rebuild first
+        switches it to incremental vacuum if it isn't already.
+        Counts should have just been flushed.
+        """
+        report = MaintenanceReport()
+        report.bytes_before = await self.storage.size_on_disk()
+
+        if archive:
+            report.archived = await self.storage.archive_regulars()
+            ROWS_ARCHIVED.inc(report.archived)
+
+        if prune_after_seconds is not None:
+            for guild, policy in guilds:
+                if guild is None:
+                    # Not connected to it right now, so there's no telling who's still there
+                    continue
+                report.departed += await self._sweep_departures(guild)
+                report.pruned += await self._prune(guild, policy, time.time() - prune_after_seconds)
+            ROWS_PRUNED.inc(report.pruned)
+
+        if compact:
+            if rebuild:
+                report.rebuilt = await self.storage.enable_incremental_vacuum()
+            # Without incremental vacuum the free pages just stay free until a rebuild
+            if await self.storage.uses_incremental_vacuum():
+                while await self.storage.incremental_vacuum(VACUUM_STEP_PAGES):
+                    pass
+            await self.storage.analyze()
+
+        report.bytes_after = await self.storage.size_on_disk()
+        BYTES_RECLAIMED.inc(report.bytes_reclaimed)
+        return report
+
+    async def _sweep_departures(self, guild: discord.Guild):
+        """
+        Notes anyone with a count who isn't in the guild any more. That's
+        only knowable with every member cached; in lazy mode departures are
+        noted as reconciliation runs into them instead.
+        """
+        if self.members.mode != FULL or not guild.chunked:
+            return 0
+        departed = 0
+        after_user_id = 0
+        while user_ids := await self.storage.get_user_ids(guild.id, after_user_id, MAINTENANCE_BATCH):
+            after_user_id = user_ids[-1]
+            gone = [user_id for user_id in user_ids if guild.get_member(user_id) is None]
+            if gone:
+                departed += await self.storage.record_departures(guild.id, gone)
+        return departed
+
+    async def _lookup(self, guild: discord.Guild, user_id):
+        """
+        The member, or None if they've left. With every member cached the
+        cache is the truth; in lazy mode it only holds recent talkers, so ask
+        Discord before deleting anything.
+        """
+        member = self.members.get(guild, user_id)
+        if member is None and self.members.mode != FULL:
+            # Lookups share the guild's rate limit with role grants and replies,
+            # so a long list of departures can't crowd them out
+            await self.dispatch_queue.throttle(guild.id)
+            member = await self.members.resolve(guild, user_id)
+        return member
+
+    async def _prune(self, guild: discord.Guild, policy: GuildPolicy, left_before):
+        pruned = 0
+        after_user_id = 0
+        while user_ids := await self.storage.get_due_departures(policy.guild_id, left_before, after_user_id, MAINTENANCE_BATCH):
+            # Users we couldn't check stay noted, so page past them rather than re-reading them
+            after_user_id = user_ids[-1]
+            returned, gone = [], []
+            for user_id in user_ids:
+                entry = self.counter_cache.entries.get((policy.guild_id, user_id))
+                # Still talking in the guild
+                if entry is not None and entry.dirty:
+                    returned.append(user_id)
+                    continue
+                try:
+                    member = await self._lookup(guild, user_id)
+                except discord.HTTPException as e:
+                    # Can't tell whether they're still there, so leave them for the next run
+                    print(f"couldn't check whether {user_id} left guild {guild.id}, not pruning them: {e}")
+                    continue
+                if member is not None:
+                    returned.append(user_id)
+                else:
+                    gone.append(user_id)
+            if returned:
+                await self.storage.clear_departures(policy.guild_id, returned)
+            if gone:
+                pruned += await self.storage.prune_users(policy.guild_id, gone)
+                for user_id in gone:
+                    self.counter_cache.forget(policy.guild_id, user_id)
+                self.leaderboards.forget(policy.guild_id, gone)
+        return pruned
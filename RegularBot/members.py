@@ -0,0 +1,88 @@
+"""
+Member lookups for RegularBot.
+
+In "full" member cache mode discord.py chunks every guild at startup and keeps
+every member in memory, which on big guilds takes minutes and hundreds of MB.
+The message handler doesn't need any of that, since the author of a message
+arrives with their roles attached. In "lazy" mode nothing is chunked, only
+recently active members are kept (in a bounded LRU), and anything else is
+fetched over REST when the reconciliation or notification paths need it.
+"""
+
+from collections import OrderedDict
+import discord
+from RegularBot import metrics
+
+MEMBER_LOOKUPS = metrics.counter("regularbot_member_lookups_total", "Member lookups, by where the member was found")
+
+# Member cache modes
+FULL = "full"
+LAZY = "lazy"
+MODES = (FULL, LAZY)
+
+# Recently seen members kept in lazy mode
+MAX_MEMBERS = 10000
+
+def client_options(mode, intents: discord.Intents):
+    """
+    Intents and discord.Client options for a member cache mode
+    """
+    # Copy, so the caller's intents aren't changed under them
+    intents = discord.Intents(**dict(intents))
+    if mode == LAZY:
+        # No privileged members intent means no chunking and no member events to keep up with
+        intents.members = False
+        return intents, {"chunk_guilds_at_startup": False, "member_cache_flags": discord.MemberCacheFlags.none()}
+    intents.members = True
+    return intents, {"chunk_guilds_at_startup": True}
+
+class MemberCache:
+
+    def __init__(self, mode=FULL, max_size=MAX_MEMBERS):
+        self.mode = mode
+        # discord.py already holds every member in full mode, so there's nothing to track
+        self.max_size = max_size if mode == LAZY else 0
+        self.entries: OrderedDict[tuple[int, int], discord.Member] = OrderedDict()
+
+    def remember(self, member: discord.Member):
+        if not self.max_size:
+            return
+        key = (member.guild.id, member.id)
+        self.entries[key] = member
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def forget(self, guild_id, user_id):
+        self.entries.pop((guild_id, user_id), None)
+
+    def get(self, guild: discord.Guild, user_id):
+        """
+        A member from discord.py's cache or ours, without touching the network
+        """
+        member = guild.get_member(user_id)
+        if member is not None:
+            MEMBER_LOOKUPS.child("source", "discord").inc()
+            return member
+        member = self.entries.get((guild.id, user_id))
+        if member is not None:
+            self.entries.move_to_end((guild.id, user_id))
+            MEMBER_LOOKUPS.child("source", "lru").inc()
+        return member
+
+    async def resolve(self, guild: discord.Guild, user_id):
+        """
+        Like get, but falls back to fetching the member. Returns None if
+        they're no longer in the guild.
+        """
+        member = self.get(guild, user_id)
+        if member is not None:
+            return member
+        MEMBER_LOOKUPS.child("source", "fetch").inc()
+        try:
+            member = await guild.fetch_member(user_id)
+        except discord.NotFound:
+            self.forget(guild.id, user_id)
+            return None
+        self.remember(member)
+        return member
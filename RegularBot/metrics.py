@@ -0,0 +1,229 @@
+"""
+In-process metrics for RegularBot, served in the Prometheus text format.
+
+Recording is kept cheap enough to leave on permanently: a counter is one
+addition, and a histogram observation is a bisect over a short, fixed bucket
+list plus two additions. A labelled child is created the first time its
+label value is seen, and looked up in a dict after that.
+
+Counters are only ever touched from the event loop. Histograms are also
+recorded by the storage threads, so each one takes a lock (uncontended
+nearly always) to observe, add a child or be read for /metrics.
+
+Modules declare the metrics they own at import time using counter(),
+histogram() and gauge(), which all register with the shared REGISTRY.
+"""
+
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds in seconds, from 10 microseconds up to 10 seconds
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = "counter"
+
+    __slots__ = ("name", "help", "value", "labels", "children")
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.labels = labels
+        self.children: dict[str, Counter] = {}
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def child(self, label_name, label_value):
+        """
+        The counter for one value of a label, e.g. counter.child("op", "add_users")
+        """
+        child = self.children.get(label_value)
+        if child is None:
+            child = Counter(self.name, self.help, self.labels + ((label_name, label_value),))
+            self.children[label_value] = child
+        return child
+
+    def samples(self):
+        if self.children:
+            for child in self.children.values():
+                yield from child.samples()
+        else:
+            yield self.name, self.labels, self.value
+
+class Gauge:
+    """
+    A value read from a callback when metrics are collected, so there's
+    nothing to record on the hot path at all
+    """
+    kind = "gauge"
+
+    __slots__ = ("name", "help", "func")
+
+    def __init__(self, name, help, func=None):
+        self.name = name
+        self.help = help
+        self.func = func
+
+    def samples(self):
+        if self.func is not None:
+            yield self.name, (), self.func()
+
+class Histogram:
+    kind = "histogram"
+
+    __slots__ = ("name", "help", "buckets", "counts", "sum", "count", "labels", "children", "lock")
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # One slot per bucket plus one for +Inf; cumulated when rendered
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.labels = labels
+        self.children: dict[str, Histogram] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def child(self, label_name, label_value):
+        child = self.children.get(label_value)
+        if child is None:
+            with self.lock:
+                # Another thread may have added it while we waited
+                child = self.children.get(label_value)
+                if child is None:
+                    child = Histogram(self.name, self.help, self.buckets, self.labels + ((label_name, label_value),))
+                    self.children[label_value] = child
+        return child
+
+    def samples(self):
+        # A consistent snapshot, so _count always matches the +Inf bucket
+        with self.lock:
+            children = list(self.children.values())
+            counts, total, count = list(self.counts), self.sum, self.count
+        if children:
+            for child in children:
+                yield from child.samples()
+            return
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            yield self.name + "_bucket", self.labels + (("le", _format_value(bound)),), cumulative
+        yield self.name + "_sum", self.labels, total
+        yield self.name + "_count", self.labels, count
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics: dict[str, Counter | Gauge | Histogram] = {}
+
+    def register(self, metric):
+        # Re-registering a name hands back the original, so modules can be reloaded safely
+        return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+def counter(name, help):
+    return REGISTRY.register(Counter(name, help))
+
+def histogram(name, help, buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, buckets))
+
+def gauge(name, help, func=None):
+    return REGISTRY.register(Gauge(name, help, func))
+
+class MetricsServer:
+    """
+    Bare-bones HTTP listener that answers every GET with the current metrics
+    """
+
+    def __init__(self, host, port, registry=REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Skip the headers, we don't need any of them
+            while await asyncio.wait_for(reader.readline(), timeout=5) not in (b"\r\n", b"\n", b""):
+                pass
+
+            if request_line.startswith(b"GET "):
+                status = "200 OK"
+                body = self.registry.render().encode()
+            else:
+                status = "405 Method Not Allowed"
+                body = b""
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
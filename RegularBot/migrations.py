@@ -0,0 +1,202 @@
+"""
+Schema migrations for the RegularBot database.
+
+The schema version is kept in SQLite's `user_version` pragma. Each migration
+moves the database from version N-1 to N and runs in its own transaction, so
+a failed migration leaves the database at the last good version.
+"""
+
+import sqlite3
+
+def _table_exists(conn: sqlite3.Connection, name):
+    res = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,))
+    return res.fetchone() is not None
+
+def migrate_v1(conn: sqlite3.Connection):
+    """
+    Typed tables with primary keys. The original tables had no types and no
+    key, so every lookup was a full scan and duplicate rows were possible.
+    """
+    legacy_users = _table_exists(conn, "users")
+    legacy_timezones = _table_exists(conn, "timezones")
+    if legacy_users:
+        conn.execute("ALTER TABLE users RENAME TO users_v0")
+    if legacy_timezones:
+        conn.execute("ALTER TABLE timezones RENAME TO timezones_v0")
+
+    conn.execute("""
+        CREATE TABLE users(
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            encouraged INTEGER NOT NULL DEFAULT 0,
+            congratulated INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE timezones(
+            user_id INTEGER PRIMARY KEY,
+            timezone TEXT NOT NULL
+        )
+    """)
+
+    if legacy_users:
+        # Collapse any duplicate rows, keeping the furthest-along values
+        conn.execute("""
+            INSERT INTO users(guild_id, user_id, message_count, encouraged, congratulated)
+            SELECT CAST(guild_id AS INTEGER), CAST(user_id AS INTEGER),
+                   MAX(COALESCE(message_count, 0)), MAX(COALESCE(encouraged, 0)), MAX(COALESCE(congratulated, 0))
+            FROM users_v0
+            GROUP BY 1, 2
+        """)
+        conn.execute("DROP TABLE users_v0")
+
+    if legacy_timezones:
+        # The most recently written row for a user is the one that was in use
+        conn.execute("""
+            INSERT INTO timezones(user_id, timezone)
+            SELECT CAST(user_id AS INTEGER), timezone
+            FROM timezones_v0
+            WHERE rowid IN (SELECT MAX(rowid) FROM timezones_v0 GROUP BY user_id)
+        """)
+        conn.execute("DROP TABLE timezones_v0")
+
+def migrate_v2(conn: sqlite3.Connection):
+    """
+    Track which users over the threshold are confirmed to hold the role, so
+    the reconciliation sweep only has to look at the ones that aren't
+    """
+    conn.execute("ALTER TABLE users ADD COLUMN reconciled INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX users_unreconciled ON users(guild_id, message_count) WHERE reconciled = 0")
+
+def migrate_v3(conn: sqlite3.Connection):
+    """
+    Per-channel progress for history backfills, so an interrupted one picks
+    up where it stopped. `before_id` pins the end of the range being
+    backfilled, so a resumed run covers exactly the same messages.
+    """
+    conn.execute("""
+        CREATE TABLE backfill_checkpoints(
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            before_id INTEGER NOT NULL,
+            last_message_id INTEGER NOT NULL DEFAULT 0,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            done INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, channel_id)
+        ) WITHOUT ROWID
+    """)
+
+def migrate_v4(conn: sqlite3.Connection):
+    """
+    Hash of the slash commands last synced to each scope, so restarts only
+    sync when the commands actually changed. Scope 0 is the global commands,
+    anything else is a guild ID.
+    """
+    conn.execute("""
+        CREATE TABLE command_sync(
+            scope INTEGER PRIMARY KEY,
+            hash TEXT NOT NULL
+        )
+    """)
+
+def migrate_v5(conn: sqlite3.Connection):
+    """
+    Each guild's leaderboards, as packed (user_id, message_count) pairs, so
+    they're ready at startup without scanning the users table
+    """
+    conn.execute("""
+        CREATE TABLE leaderboards(
+            guild_id INTEGER NOT NULL,
+            board TEXT NOT NULL,
+            threshold INTEGER NOT NULL,
+            entries BLOB NOT NULL,
+            PRIMARY KEY (guild_id, board)
+        ) WITHOUT ROWID
+    """)
+
+def migrate_v6(conn: sqlite3.Connection):
+    """
+    Cold storage for Regulars who are confirmed to have the role, so the
+    users table only holds people still working towards it, plus when members
+    left each guild so their rows can be pruned after a grace period
+    """
+    conn.execute("""
+        CREATE TABLE users_archive(
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            archived_at INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE departures(
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            left_at INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, user_id)
+        ) WITHOUT ROWID
+    """)
+
+def migrate_v7(conn: sqlite3.Connection):
+    """
+    When each worker process last finished database maintenance, so a
+    restart waits out the rest of the interval instead of running it again.
+    Keyed by worker because each one prunes its own guilds.
+    """
+    conn.execute("""
+        CREATE TABLE maintenance_runs(
+            worker INTEGER PRIMARY KEY,
+            finished_at INTEGER NOT NULL
+        )
+    """)
+
+def migrate_v8(conn: sqlite3.Connection):
+    """
+    Each leaderboard's floor (see RegularBot/leaderboard.py), so users
+    crossing the threshold don't force a rebuild. Boards saved before this
+    have none, and are rebuilt once when they're loaded.
+    """
+    conn.execute("ALTER TABLE leaderboards ADD COLUMN floor INTEGER")
+
+# Index i holds the migration to version i+1
+MIGRATIONS = [
+    migrate_v1,
+    migrate_v2,
+    migrate_v3,
+    migrate_v4,
+    migrate_v5,
+    migrate_v6,
+    migrate_v7,
+    migrate_v8,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate(conn: sqlite3.Connection):
+    """
+    Bring the database up to SCHEMA_VERSION. Returns the version it started at.
+    """
+    start_version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if start_version > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema version {start_version} is newer than this bot supports ({SCHEMA_VERSION})")
+
+    for version in range(start_version + 1, SCHEMA_VERSION + 1):
+        # IMMEDIATE takes the write lock before checking the version, so when
+        # several bot processes start at once only one of them runs each step
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                conn.rollback()
+                continue
+            print(f"migrating database to schema version {version}")
+            MIGRATIONS[version - 1](conn)
+            conn.execute(f"PRAGMA user_version={version}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    return start_version
@@ -0,0 +1,177 @@
+"""
+Crash notices for RegularBot's maintainers.
+
+When the bot crashes, the notice is written to an outbox on disk and the bot
+reboots straight away. The notices are delivered afterwards over REST only,
+either by the rebooted client (which is already logged in) or, if the bot
+gives up on rebooting, by a bare client that logs in without ever opening a
+gateway connection. Nothing is lost if delivery fails; a notice only leaves
+the outbox once every maintainer has it.
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+import discord
+
+OUTBOX_DIR = "db/outbox"
+# Discord's limit on message length
+MAX_MESSAGE_LENGTH = 2000
+# Tries per REST call before leaving the notice for next time
+SEND_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 1
+RETRY_MAX_SECONDS = 30
+
+CRASH_HEADER = "The bot encountered a fatal error with the following details: \n"
+
+def format_crash(traceback_lines):
+    """
+    A crash notice that fits in one message. Long tracebacks keep their end,
+    which is where the actual error is.
+    """
+    body = "\n".join(traceback_lines)
+    room = MAX_MESSAGE_LENGTH - len(CRASH_HEADER) - len(" ``````")
+    if len(body) > room:
+        body = "..." + body[-(room - 3):]
+    return f"{CRASH_HEADER} ```{body}```"
+
+class CrashOutbox:
+    """
+    One json file per notice, so writing one is atomic and a crash mid-write
+    can't corrupt the others
+    """
+
+    def __init__(self, path=OUTBOX_DIR):
+        self.path = path
+
+    def put(self, text):
+        os.makedirs(self.path, exist_ok=True)
+        name = f"{time.time_ns()}-{os.getpid()}.json"
+        tmp_path = os.path.join(self.path, name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"created": time.time(), "text": text, "delivered_to": []}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.path, name))
+
+    def pending(self):
+        """
+        [(path, notice)] oldest first
+        """
+        if not os.path.isdir(self.path):
+            return []
+        notices = []
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                with open(path) as f:
+                    notices.append((path, json.load(f)))
+            except (OSError, ValueError) as e:
+                print(f"dropping unreadable crash notice {path}: {e}")
+                os.remove(path)
+        return notices
+
+    def update(self, path, notice):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(notice, f)
+        os.replace(tmp_path, path)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def _batches(notices):
+    """
+    Packs notices into as few messages as possible
+    """
+    batch, length = [], 0
+    for path, notice in notices:
+        size = len(notice["text"]) + 1
+        if batch and length + size > MAX_MESSAGE_LENGTH:
+            yield batch
+            batch, length = [], 0
+        batch.append((path, notice))
+        length += size
+    if batch:
+        yield batch
+
+async def with_retries(call):
+    for attempt in range(SEND_ATTEMPTS):
+        try:
+            return await call()
+        except (discord.Forbidden, discord.NotFound):
+            # Retrying won't fix these
+            raise
+        except (discord.HTTPException, OSError):
+            if attempt == SEND_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+async def dm_channel(client: discord.Client, user_id):
+    user = client.get_user(user_id) or await with_retries(lambda: client.fetch_user(user_id))
+    return user.dm_channel or await with_retries(user.create_dm)
+
+class OutboxSender:
+    """
+    Delivers an outbox using nothing but REST calls on a logged-in client
+    """
+
+    def __init__(self, client: discord.Client, recipient_ids):
+        self.client = client
+        self.recipient_ids = recipient_ids
+
+    async def deliver(self, outbox: CrashOutbox):
+        """
+        Sends every pending notice to every recipient that doesn't have it yet.
+        Returns how many notices were fully delivered and removed.
+        """
+        notices = await asyncio.to_thread(outbox.pending)
+        if not notices:
+            return 0
+
+        for user_id in self.recipient_ids:
+            todo = [(path, notice) for path, notice in notices if user_id not in notice["delivered_to"]]
+            if not todo:
+                continue
+            try:
+                channel = await dm_channel(self.client, user_id)
+                for batch in _batches(todo):
+                    text = "\n".join(notice["text"] for _, notice in batch)
+                    await with_retries(lambda: channel.send(text))
+                    for path, notice in batch:
+                        notice["delivered_to"].append(user_id)
+                        await asyncio.to_thread(outbox.update, path, notice)
+            except (discord.Forbidden, discord.NotFound) as e:
+                # They can't be DMed (or don't exist), so don't hold the outbox up for them
+                print(f"can't send crash notices to {user_id}: {e}")
+                for path, notice in todo:
+                    if user_id not in notice["delivered_to"]:
+                        notice["delivered_to"].append(user_id)
+                        await asyncio.to_thread(outbox.update, path, notice)
+            except (discord.HTTPException, OSError) as e:
+                print(f"failed to send crash notices to {user_id}, will try again later: {e}")
+
+        delivered = 0
+        for path, notice in notices:
+            if all(user_id in notice["delivered_to"] for user_id in self.recipient_ids):
+                await asyncio.to_thread(outbox.remove, path)
+                delivered += 1
+        return delivered
+
+async def deliver_over_rest(token, recipient_ids, outbox: CrashOutbox):
+    """
+    Logs in over REST only (no gateway, so no identify) and delivers the outbox
+    """
+    client = discord.Client(intents=discord.Intents.none())
+    try:
+        await client.login(token)
+        return await OutboxSender(client, recipient_ids).deliver(outbox)
+    finally:
+        await client.close()
@@ -0,0 +1,240 @@
+"""
+On-demand runtime profiling for RegularBot.
+
+Maintainers start a profile with /rbprofile and it stops by itself after a
+bounded time. While it runs:
+ - a sampler thread records the event loop thread's stack every
+   SAMPLE_INTERVAL_SECONDS, so we see where the loop spends its time without
+   the cost of tracing every call
+ - tracemalloc tracks allocations, and the end snapshot is compared against
+   the start one
+ - a tasks.loop probe records event loop lag and the number of asyncio tasks
+
+Nothing here runs until a profile is started: no thread, no tracing, no
+probe. Each profile is written to its own directory under the output
+directory.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from discord.ext import tasks
+
+PROFILE_DIR = "db/profiles"
+# Upper bound on a profile, in case nobody stops it
+MAX_PROFILE_SECONDS = 600
+DEFAULT_PROFILE_SECONDS = 60
+SAMPLE_INTERVAL_SECONDS = 0.005
+LOOP_PROBE_SECONDS = 0.5
+# Frames kept per tracemalloc traceback
+TRACEMALLOC_FRAMES = 10
+# Lines written to the summaries
+REPORT_LINES = 40
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class StackSampler:
+    """
+    Counts the stacks one thread is in, sampled from another thread
+    """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL_SECONDS):
+        self.thread_id = thread_id
+        self.interval = interval
+        # Stacks, outermost frame first -> samples
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="regularbot-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[tuple(stack)] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """
+        One "outer;...;inner count" line per stack, the format flame graph tools read
+        """
+        return [f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common()]
+
+    def hottest(self, n=REPORT_LINES):
+        """
+        [(function, own samples, total samples)], by own samples. Total counts
+        a function once per sample, however deep it recurses.
+        """
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for name in set(stack):
+                total[name] += count
+        return [(name, samples, total[name]) for name, samples in own.most_common(n)]
+
+class LoopProbe:
+    """
+    Event loop lag and task counts, sampled by a tasks.loop that only runs during a profile
+    """
+
+    def __init__(self, interval=LOOP_PROBE_SECONDS):
+        self.interval = interval
+        # (seconds since start, lag in ms, tasks)
+        self.samples: list[tuple[float, float, int]] = []
+        self._started = None
+        self._last = None
+        self.probe.change_interval(seconds=interval)
+
+    @tasks.loop(seconds=LOOP_PROBE_SECONDS)
+    async def probe(self):
+        now = time.perf_counter()
+        if self._last is None:
+            self._started = now
+        else:
+            # However late this iteration is, the loop was too busy to run it on time
+            lag = max(0.0, now - self._last - self.interval)
+            self.samples.append((now - self._started, lag * 1000, len(asyncio.all_tasks())))
+        self._last = now
+
+    def start(self):
+        self.probe.start()
+
+    def stop(self):
+        self.probe.cancel()
+
+    def summary(self):
+        if not self.samples:
+            return "no loop samples"
+        lags = sorted(lag for _, lag, _ in self.samples)
+        tasks_seen = [count for _, _, count in self.samples]
+        return (
+            f"loop lag ms: p50 {lags[len(lags) // 2]:.1f}, p99 {lags[min(len(lags) - 1, int(len(lags) * 0.99))]:.1f}, max {lags[-1]:.1f}; "
+            f"tasks: min {min(tasks_seen)}, max {max(tasks_seen)}"
+        )
+
+class RuntimeProfiler:
+
+    def __init__(self, output_dir=PROFILE_DIR, worker=0):
+        self.output_dir = output_dir
+        self.worker = worker
+        self.path = None
+        self.started_at = None
+        self.seconds = None
+        self._sampler = None
+        self._probe = None
+        self._baseline = None
+        # Whether we turned tracemalloc on, so we only turn off what we started
+        self._owns_tracemalloc = False
+        self._timer = None
+
+    @property
+    def running(self):
+        return self._sampler is not None
+
+    def status(self):
+        if not self.running:
+            return "not profiling"
+        left = self.started_at + self.seconds - time.time()
+        return f"profiling into {self.path}, {self._sampler.samples} samples so far, stops in {max(0, left):.0f}s"
+
+    async def start(self, seconds=DEFAULT_PROFILE_SECONDS):
+        """
+        Starts profiling for `seconds` (capped at MAX_PROFILE_SECONDS). Returns where the results will go.
+        """
+        if self.running:
+            raise RuntimeError(f"already {self.status()}")
+        self.seconds = max(1, min(seconds, MAX_PROFILE_SECONDS))
+        self.started_at = time.time()
+        self.path = os.path.join(self.output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-worker{self.worker}")
+
+        # Sample the thread running the event loop, i.e. this one. Set before
+        # waiting on anything, so a second start is refused.
+        self._sampler = StackSampler(threading.get_ident())
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._owns_tracemalloc = True
+        self._baseline = await asyncio.to_thread(tracemalloc.take_snapshot)
+        self._sampler.start()
+        self._probe = LoopProbe()
+        self._probe.start()
+        self._timer = asyncio.create_task(self._stop_after(self.seconds))
+        return self.path
+
+    async def _stop_after(self, seconds):
+        await asyncio.sleep(seconds)
+        self._timer = None
+        path = await self.stop()
+        print(f"profile finished, results in {path}")
+
+    async def stop(self):
+        """
+        Stops profiling and writes the results. Returns the directory they're in.
+        """
+        if not self.running:
+            raise RuntimeError("not profiling")
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        sampler, probe, baseline = self._sampler, self._probe, self._baseline
+        self._sampler = self._probe = self._baseline = None
+
+        probe.stop()
+        await asyncio.to_thread(sampler.stop)
+        snapshot = await asyncio.to_thread(tracemalloc.take_snapshot)
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+            self._owns_tracemalloc = False
+
+        path = self.path
+        await asyncio.to_thread(self._write, path, time.time() - self.started_at, sampler, probe, baseline, snapshot)
+        return path
+
+    def _write(self, path, elapsed, sampler: StackSampler, probe: LoopProbe, baseline, snapshot):
+        os.makedirs(path, exist_ok=True)
+
+        with open(os.path.join(path, "stacks.txt"), "w") as f:
+            f.write("\n".join(sampler.collapsed()) + "\n")
+
+        with open(os.path.join(path, "summary.txt"), "w") as f:
+            f.write(f"{elapsed:.1f}s, {sampler.samples} samples every {sampler.interval * 1000:.0f}ms\n")
+            f.write(probe.summary() + "\n\n")
+            f.write("own%   total%  function\n")
+            for name, own, total in sampler.hottest():
+                f.write(f"{own * 100 / max(1, sampler.samples):5.1f}  {total * 100 / max(1, sampler.samples):6.1f}  {name}\n")
+
+        with open(os.path.join(path, "loop.csv"), "w") as f:
+            f.write("seconds,lag_ms,tasks\n")
+            for seconds, lag, count in probe.samples:
+                f.write(f"{seconds:.3f},{lag:.3f},{count}\n")
+
+        with open(os.path.join(path, "memory.txt"), "w") as f:
+            f.write(f"traced now: {sum(stat.size for stat in snapshot.statistics('filename')) / 1024:.1f} KiB\n")
+            f.write("\nGrowth since the profile started, by line:\n")
+            for stat in snapshot.compare_to(baseline, "lineno")[:REPORT_LINES]:
+                f.write(f"{stat}\n")
+            f.write("\nLargest allocations, by line:\n")
+            for stat in snapshot.statistics("lineno")[:REPORT_LINES]:
+                f.write(f"{stat}\n")
+        # The raw snapshot, for digging further with tracemalloc.Snapshot.load
+        snapshot.dump(os.path.join(path, "memory.snapshot"))
@@ -0,0 +1,578 @@
+"""
+SQLite storage layer for RegularBot.
+
+All writes go through a single long-lived connection that lives on its own
+worker thread, so queries never block the event loop. Reads that don't need
+to be ordered with writes go to a small pool of read-only connections
+instead; with WAL they see the last committed state without waiting behind
+the writer. Statements are plain parameterized SQL constants, which lets
+sqlite3's statement cache reuse the compiled statement on every call instead
+of re-preparing it.
+
+Several bot processes can share one database file when the bot is sharded
+across processes. Every guild belongs to exactly one shard, so no two
+processes ever count the same (guild, user); on top of that, counts are only
+ever written as deltas, WAL lets each process read while another writes, and
+busy_timeout makes writers queue for the lock instead of failing.
+"""
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from RegularBot import metrics
+from RegularBot.migrations import migrate
+
+# Negative values are in KiB, so this is a 16 MiB page cache
+CACHE_SIZE_KIB = 16000
+# How long a writer waits on a locked database before giving up
+BUSY_TIMEOUT_MS = 5000
+# Number of compiled statements sqlite3 keeps around for reuse
+STATEMENT_CACHE_SIZE = 64
+# Threads (and read-only connections) serving reads
+READERS = 2
+# PRAGMA auto_vacuum value for INCREMENTAL
+AUTO_VACUUM_INCREMENTAL = 2
+# Rows ANALYZE samples per index
+ANALYSIS_LIMIT = 1000
+
+SQLITE_OP_SECONDS = metrics.histogram("regularbot_sqlite_op_seconds", "Time the worker thread spends on each storage operation, including its commit")
+SQLITE_COMMIT_SECONDS = metrics.histogram("regularbot_sqlite_commit_seconds", "Time spent committing transactions")
+
+# Falls back to the archive, so archived Regulars still read back with their full count
+SQL_SELECT_USER = """
+    SELECT message_count, encouraged, congratulated FROM users WHERE guild_id=? AND user_id=?
+    UNION ALL
+    SELECT message_count, 1, 1 FROM users_archive WHERE guild_id=? AND user_id=?
+    LIMIT 1
+"""
+# Counts one message and hands back the new state in a single round trip
+SQL_INCREMENT_USER = """
+    INSERT INTO users(guild_id, user_id, message_count) VALUES (?, ?, 1)
+    ON CONFLICT(guild_id, user_id) DO UPDATE SET message_count = message_count + 1
+    RETURNING message_count, encouraged, congratulated
+"""
+# message_count is a delta here, so concurrent writers never clobber each other
+SQL_ADD_USER = """
+    INSERT INTO users(guild_id, user_id, message_count, encouraged, congratulated) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(guild_id, user_id) DO UPDATE SET
+        message_count = message_count + excluded.message_count,
+        encouraged = MAX(encouraged, excluded.encouraged),
+        congratulated = MAX(congratulated, excluded.congratulated)
+"""
+# Moves an archived user back into users before anything is counted for them; a no-op for everyone else
+SQL_RESTORE_ARCHIVED = """
+    INSERT INTO users(guild_id, user_id, message_count, encouraged, congratulated, reconciled)
+    SELECT guild_id, user_id, message_count, 1, 1, 1 FROM users_archive WHERE guild_id=? AND user_id=?
+    ON CONFLICT(guild_id, user_id) DO UPDATE SET
+        message_count = message_count + excluded.message_count,
+        encouraged = 1,
+        congratulated = 1,
+        reconciled = 1
+"""
+SQL_DELETE_ARCHIVED = "DELETE FROM users_archive WHERE guild_id=? AND user_id=?"
+# Pages through users over the threshold that haven't been confirmed to have the role
+# Pages in users_unreconciled order, so a sweep only reads rows over the threshold
+SQL_SELECT_UNRECONCILED = """
+    SELECT message_count, user_id FROM users
+    WHERE guild_id=? AND reconciled=0 AND message_count>=? AND (message_count, user_id)>(?, ?)
+    ORDER BY message_count, user_id LIMIT ?
+"""
+SQL_MARK_RECONCILED = "UPDATE users SET reconciled=1 WHERE guild_id=? AND user_id=?"
+SQL_SELECT_CHECKPOINTS = "SELECT channel_id, before_id, last_message_id, message_count, done FROM backfill_checkpoints WHERE guild_id=?"
+SQL_UPSERT_CHECKPOINT = """
+    INSERT INTO backfill_checkpoints(guild_id, channel_id, before_id, last_message_id, message_count, done) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(guild_id, channel_id) DO UPDATE SET
+        last_message_id = excluded.last_message_id,
+        message_count = excluded.message_count,
+        done = excluded.done
+"""
+# Only used to rebuild a leaderboard, which is rare; the leaderboards themselves are kept in memory
+SQL_SELECT_TOP_USERS = """
+    SELECT user_id, message_count FROM users WHERE guild_id=? AND message_count<?
+    UNION ALL
+    SELECT user_id, message_count FROM users_archive WHERE guild_id=? AND message_count<?
+    ORDER BY message_count DESC LIMIT ?
+"""
+SQL_SELECT_LEADERBOARDS = "SELECT guild_id, board, threshold, entries, floor FROM leaderboards"
+SQL_UPSERT_LEADERBOARD = """
+    INSERT INTO leaderboards(guild_id, board, threshold, entries, floor) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(guild_id, board) DO UPDATE SET threshold = excluded.threshold, entries = excluded.entries, floor = excluded.floor
+"""
+# Regulars who are confirmed to have the role don't need to be in the hot table any more
+SQL_ARCHIVE_REGULARS = """
+    INSERT INTO users_archive(guild_id, user_id, message_count, archived_at)
+    SELECT guild_id, user_id, message_count, ? FROM users WHERE congratulated=1 AND reconciled=1
+    ON CONFLICT(guild_id, user_id) DO UPDATE SET message_count = message_count + excluded.message_count
+"""
+SQL_DELETE_ARCHIVED_REGULARS = "DELETE FROM users WHERE congratulated=1 AND reconciled=1"
+# Everyone with a row in a guild, archived or not, in ID order
+SQL_SELECT_GUILD_USER_IDS = """
+    SELECT user_id FROM users WHERE guild_id=? AND user_id>?
+    UNION
+    SELECT user_id FROM users_archive WHERE guild_id=? AND user_id>?
+    ORDER BY user_id LIMIT ?
+"""
+# Keeps the first time we noticed they left, so the grace period isn't pushed back
+SQL_INSERT_DEPARTURE = "INSERT INTO departures(guild_id, user_id, left_at) VALUES (?, ?, ?) ON CONFLICT(guild_id, user_id) DO NOTHING"
+SQL_DELETE_DEPARTURE = "DELETE FROM departures WHERE guild_id=? AND user_id=?"
+SQL_SELECT_DEPARTURE = "SELECT 1 FROM departures WHERE guild_id=? AND user_id=?"
+SQL_SELECT_DUE_DEPARTURES = "SELECT user_id FROM departures WHERE guild_id=? AND left_at<=? AND user_id>? ORDER BY user_id LIMIT ?"
+SQL_DELETE_USER = "DELETE FROM users WHERE guild_id=? AND user_id=?"
+SQL_SELECT_COMMAND_HASHES = "SELECT scope, hash FROM command_sync"
+SQL_UPSERT_COMMAND_HASH = """
+    INSERT INTO command_sync(scope, hash) VALUES (?, ?)
+    ON CONFLICT(scope) DO UPDATE SET hash = excluded.hash
+"""
+SQL_SELECT_MAINTENANCE_RUN = "SELECT finished_at FROM maintenance_runs WHERE worker=?"
+SQL_UPSERT_MAINTENANCE_RUN = """
+    INSERT INTO maintenance_runs(worker, finished_at) VALUES (?, ?)
+    ON CONFLICT(worker) DO UPDATE SET finished_at = excluded.finished_at
+"""
+SQL_SELECT_TIMEZONE = "SELECT timezone FROM timezones WHERE user_id=?"
+SQL_UPSERT_TIMEZONE = """
+    INSERT INTO timezones(user_id, timezone) VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET timezone = excluded.timezone
+"""
+
+class RegularBotStorage:
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # One worker means one connection and no need for locking around it
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="regularbot-sql")
+        self._conn = None
+        self._read_executor = ThreadPoolExecutor(max_workers=READERS, thread_name_prefix="regularbot-sql-read")
+        # Each reader thread keeps its own connection; the list is so close() can find them all
+        self._read_local = threading.local()
+        self._read_conns: list[sqlite3.Connection] = []
+        self._read_conns_lock = threading.Lock()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._timed, func, args)
+
+    async def _run_read(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_executor, self._timed, func, args)
+
+    @staticmethod
+    def _timed(func, args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            SQLITE_OP_SECONDS.child("op", func.__name__.lstrip("_")).observe(time.perf_counter() - start)
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Like `with conn:`, but times the commit
+        """
+        conn = self._connection()
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        start = time.perf_counter()
+        conn.commit()
+        SQLITE_COMMIT_SECONDS.observe(time.perf_counter() - start)
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Only ever called from the worker thread
+        """
+        if self._conn is None:
+            db_dir = os.path.dirname(self.db_path)
+            if db_dir and not os.path.isdir(db_dir):
+                os.mkdir(db_dir)
+
+            conn = sqlite3.connect(self.db_path, cached_statements=STATEMENT_CACHE_SIZE)
+            # First, so switching to WAL waits out other bot processes instead of failing
+            conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            # A brand new file can start out with incremental vacuum. Once it
+            # has pages (switching to WAL writes the first) it takes a VACUUM.
+            if conn.execute("PRAGMA page_count").fetchone()[0] == 0:
+                conn.execute(f"PRAGMA auto_vacuum={AUTO_VACUUM_INCREMENTAL}")
+            # WAL lets readers carry on while we write, and with it NORMAL
+            # sync is still safe against corruption (only fsyncs on checkpoint)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            self._conn = conn
+        return self._conn
+
+    def _reader(self) -> sqlite3.Connection:
+        """
+        Only ever called from a reader thread
+        """
+        conn = getattr(self._read_local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+            conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+            conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            self._read_local.conn = conn
+            with self._read_conns_lock:
+                self._read_conns.append(conn)
+        return conn
+
+    ###############################
+    # Setup / teardown
+    ###############################
+    def _open(self):
+        migrate(self._connection())
+
+    async def open(self):
+        await self._run(self._open)
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        # Readers are idle by now; they reconnect on their next read if the storage is reopened
+        with self._read_conns_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns.clear()
+        self._read_local = threading.local()
+
+    async def close(self):
+        await self._run(self._close)
+
+    ###############################
+    # Users
+    ###############################
+    def _get_user(self, guild_id, user_id):
+        res = self._reader().execute(SQL_SELECT_USER, (guild_id, user_id, guild_id, user_id))
+        return res.fetchone()
+
+    async def get_user(self, guild_id, user_id):
+        """
+        Returns (message_count, encouraged, congratulated), or None if the user has never been seen.
+        Reads the last committed state without queueing behind writes.
+        """
+        return await self._run_read(self._get_user, guild_id, user_id)
+
+    @staticmethod
+    def _restore_archived(conn: sqlite3.Connection, keys):
+        """
+        Moves any of these (guild_id, user_id) out of the archive, so counts
+        added after it never end up split across the two tables
+        """
+        conn.executemany(SQL_RESTORE_ARCHIVED, keys)
+        conn.executemany(SQL_DELETE_ARCHIVED, keys)
+
+    def _increment_user(self, guild_id, user_id):
+        with self._transaction() as conn:
+            self._restore_archived(conn, ((guild_id, user_id),))
+            # fetchall so the RETURNING statement is finished before the commit
+            return conn.execute(SQL_INCREMENT_USER, (guild_id, user_id)).fetchall()[0]
+
+    async def increment_user(self, guild_id, user_id):
+        """
+        Count one message for a user, creating their row if necessary.
+        Returns the updated (message_count, encouraged, congratulated).
+        """
+        return await self._run(self._increment_user, guild_id, user_id)
+
+    def _add_users(self, rows):
+        with self._transaction() as conn:
+            self._restore_archived(conn, [row[:2] for row in rows])
+            conn.executemany(SQL_ADD_USER, rows)
+
+    async def add_users(self, rows):
+        """
+        Apply a batch of (guild_id, user_id, message_count_delta, encouraged, congratulated)
+        in a single transaction
+        """
+        await self._run(self._add_users, rows)
+
+    def _get_unreconciled(self, guild_id, threshold, after, limit):
+        return self._connection().execute(SQL_SELECT_UNRECONCILED, (guild_id, threshold, *after, limit)).fetchall()
+
+    async def get_unreconciled(self, guild_id, threshold, after=(0, 0), limit=500):
+        """
+        [(message_count, user_id)] for users in a guild with at least
+        `threshold` messages who aren't known to have the role yet, in that
+        order, starting after the `after` pair
+        """
+        return await self._run(self._get_unreconciled, guild_id, threshold, after, limit)
+
+    def _mark_reconciled(self, guild_id, user_ids):
+        with self._transaction() as conn:
+            conn.executemany(SQL_MARK_RECONCILED, [(guild_id, user_id) for user_id in user_ids])
+
+    async def mark_reconciled(self, guild_id, user_ids):
+        await self._run(self._mark_reconciled, guild_id, user_ids)
+
+    ###############################
+    # Backfill
+    ###############################
+    def _get_checkpoints(self, guild_id):
+        res = self._connection().execute(SQL_SELECT_CHECKPOINTS, (guild_id,))
+        return {row[0]: row[1:] for row in res}
+
+    async def get_checkpoints(self, guild_id):
+        """
+        Maps channel_id to (before_id, last_message_id, message_count, done)
+        """
+        return await self._run(self._get_checkpoints, guild_id)
+
+    def _write_backfill_chunk(self, guild_id, channel_id, rows, checkpoint):
+        with self._transaction() as conn:
+            self._restore_archived(conn, [row[:2] for row in rows])
+            conn.executemany(SQL_ADD_USER, rows)
+            conn.execute(SQL_UPSERT_CHECKPOINT, (guild_id, channel_id, *checkpoint))
+
+    async def write_backfill_chunk(self, guild_id, channel_id, rows, checkpoint):
+        """
+        Add a chunk of backfilled counts and move the channel's checkpoint
+        forward in the same transaction, so a crash can't count a chunk twice.
+        rows are as for add_users; checkpoint is (before_id, last_message_id, message_count, done).
+        """
+        await self._run(self._write_backfill_chunk, guild_id, channel_id, rows, checkpoint)
+
+    ###############################
+    # Leaderboards
+    ###############################
+    def _get_top_users(self, guild_id, below, limit):
+        res = self._reader().execute(SQL_SELECT_TOP_USERS, (guild_id, below, guild_id, below, limit))
+        return res.fetchall()
+
+    async def get_top_users(self, guild_id, below, limit):
+        """
+        [(user_id, message_count)] for the users with the most messages under `below`
+        """
+        return await self._run_read(self._get_top_users, guild_id, below, limit)
+
+    def _get_leaderboards(self):
+        res = self._reader().execute(SQL_SELECT_LEADERBOARDS)
+        return res.fetchall()
+
+    async def get_leaderboards(self):
+        """
+        [(guild_id, board, threshold, entries, floor)] as saved by save_leaderboards
+        """
+        return await self._run_read(self._get_leaderboards)
+
+    def _save_leaderboards(self, rows):
+        with self._transaction() as conn:
+            conn.executemany(SQL_UPSERT_LEADERBOARD, rows)
+
+    async def save_leaderboards(self, rows):
+        await self._run(self._save_leaderboards, rows)
+
+    ###############################
+    # Retention
+    ###############################
+    def _archive_regulars(self):
+        with self._transaction() as conn:
+            # Take the write lock up front, so no other process can count for
+            # these users between the copy and the delete
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(SQL_ARCHIVE_REGULARS, (int(time.time()),))
+            return conn.execute(SQL_DELETE_ARCHIVED_REGULARS).rowcount
+
+    async def archive_regulars(self):
+        """
+        Moves every user who was congratulated and is confirmed to have the
+        role into users_archive. Returns how many were moved.
+        """
+        return await self._run(self._archive_regulars)
+
+    def _get_user_ids(self, guild_id, after_user_id, limit):
+        res = self._reader().execute(SQL_SELECT_GUILD_USER_IDS, (guild_id, after_user_id, guild_id, after_user_id, limit))
+        return [row[0] for row in res]
+
+    async def get_user_ids(self, guild_id, after_user_id=0, limit=500):
+        """
+        IDs of everyone with a count in a guild, archived or not, in ID order starting after `after_user_id`
+        """
+        return await self._run_read(self._get_user_ids, guild_id, after_user_id, limit)
+
+    def _record_departures(self, guild_id, user_ids, left_at):
+        with self._transaction() as conn:
+            return conn.executemany(SQL_INSERT_DEPARTURE, [(guild_id, user_id, left_at) for user_id in user_ids]).rowcount
+
+    async def record_departures(self, guild_id, user_ids, left_at=None):
+        """
+        Notes that these members left a guild. Users already noted keep their
+        original time. Returns how many weren't noted before.
+        """
+        return await self._run(self._record_departures, guild_id, user_ids, int(left_at if left_at is not None else time.time()))
+
+    def _clear_departures(self, guild_id, user_ids):
+        with self._transaction() as conn:
+            conn.executemany(SQL_DELETE_DEPARTURE, [(guild_id, user_id) for user_id in user_ids])
+
+    async def clear_departures(self, guild_id, user_ids):
+        await self._run(self._clear_departures, guild_id, user_ids)
+
+    def _get_departures(self, guild_id, user_ids):
+        conn = self._reader()
+        return {user_id for user_id in user_ids if conn.execute(SQL_SELECT_DEPARTURE, (guild_id, user_id)).fetchone()}
+
+    async def get_departures(self, guild_id, user_ids):
+        """
+        Those of user_ids noted as having left a guild
+        """
+        return await self._run_read(self._get_departures, guild_id, user_ids)
+
+    def _get_due_departures(self, guild_id, left_before, after_user_id, limit):
+        res = self._connection().execute(SQL_SELECT_DUE_DEPARTURES, (guild_id, int(left_before), after_user_id, limit))
+        return [row[0] for row in res]
+
+    async def get_due_departures(self, guild_id, left_before, after_user_id=0, limit=500):
+        """
+        IDs of members who left a guild at or before `left_before` (a unix time),
+        in ID order starting after `after_user_id`
+        """
+        return await self._run(self._get_due_departures, guild_id, left_before, after_user_id, limit)
+
+    def _prune_users(self, guild_id, user_ids):
+        keys = [(guild_id, user_id) for user_id in user_ids]
+        with self._transaction() as conn:
+            pruned = conn.executemany(SQL_DELETE_USER, keys).rowcount
+            pruned += conn.executemany(SQL_DELETE_ARCHIVED, keys).rowcount
+            conn.executemany(SQL_DELETE_DEPARTURE, keys)
+        return pruned
+
+    async def prune_users(self, guild_id, user_ids):
+        """
+        Deletes everything counted for these users in a guild. Returns how many rows went.
+        """
+        return await self._run(self._prune_users, guild_id, user_ids)
+
+    ###############################
+    # Compaction
+    ###############################
+    def _size_on_disk(self):
+        size = 0
+        for path in (self.db_path, self.db_path + "-wal"):
+            try:
+                size += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        return size
+
+    async def size_on_disk(self):
+        """
+        Bytes used by the database file and its WAL
+        """
+        return await self._run(self._size_on_disk)
+
+    def _uses_incremental_vacuum(self):
+        return self._connection().execute("PRAGMA auto_vacuum").fetchone()[0] == AUTO_VACUUM_INCREMENTAL
+
+    async def uses_incremental_vacuum(self):
+        """
+        Whether free pages can be handed back with incremental_vacuum
+        """
+        return await self._run(self._uses_incremental_vacuum)
+
+    def _enable_incremental_vacuum(self):
+        conn = self._connection()
+        if self._uses_incremental_vacuum():
+            return False
+        # The setting only sticks once the whole file is rebuilt, which VACUUM can't do inside a transaction
+        conn.commit()
+        conn.execute(f"PRAGMA auto_vacuum={AUTO_VACUUM_INCREMENTAL}")
+        conn.execute("VACUUM")
+        return True
+
+    async def enable_incremental_vacuum(self):
+        """
+        Switches the database to incremental auto-vacuum. That takes one full
+        VACUUM, which blocks writers (from every process) for as long as it
+        runs. Returns whether it had to be done.
+        """
+        return await self._run(self._enable_incremental_vacuum)
+
+    def _incremental_vacuum(self, pages):
+        conn = self._connection()
+        # Each step returns a row, so it only runs to completion once they're all read
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    async def incremental_vacuum(self, pages):
+        """
+        Gives up to `pages` free pages back to the filesystem. Returns how many
+        free pages are left. Does nothing unless uses_incremental_vacuum().
+        """
+        return await self._run(self._incremental_vacuum, pages)
+
+    def _analyze(self):
+        conn = self._connection()
+        # Sampling keeps ANALYZE quick however big the tables get
+        conn.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+        conn.execute("ANALYZE")
+        conn.commit()
+        # Fold the WAL back into the database and shrink it, if no reader is in the way
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+    async def analyze(self):
+        """
+        Refreshes the query planner's statistics and checkpoints the WAL
+        """
+        await self._run(self._analyze)
+
+    def _get_last_maintenance(self, worker):
+        row = self._reader().execute(SQL_SELECT_MAINTENANCE_RUN, (worker,)).fetchone()
+        return row[0] if row else None
+
+    async def get_last_maintenance(self, worker):
+        """
+        When a worker process last finished maintenance (a unix time), or None if it never has
+        """
+        return await self._run_read(self._get_last_maintenance, worker)
+
+    def _set_last_maintenance(self, worker, finished_at):
+        with self._transaction() as conn:
+            conn.execute(SQL_UPSERT_MAINTENANCE_RUN, (worker, int(finished_at)))
+
+    async def set_last_maintenance(self, worker, finished_at):
+        await self._run(self._set_last_maintenance, worker, finished_at)
+
+    ###############################
+    # Command sync
+    ###############################
+    def _get_command_hashes(self):
+        res = self._reader().execute(SQL_SELECT_COMMAND_HASHES)
+        return dict(res.fetchall())
+
+    async def get_command_hashes(self):
+        """
+        {scope: hash} for every scope commands were synced to
+        """
+        return await self._run_read(self._get_command_hashes)
+
+    def _set_command_hash(self, scope, hash):
+        with self._transaction() as conn:
+            conn.execute(SQL_UPSERT_COMMAND_HASH, (scope, hash))
+
+    async def set_command_hash(self, scope, hash):
+        await self._run(self._set_command_hash, scope, hash)
+
+    ###############################
+    # Timezones
+    ###############################
+    def _get_timezone(self, user_id):
+        res = self._reader().execute(SQL_SELECT_TIMEZONE, (user_id,))
+        row = res.fetchone()
+        return row[0] if row else None
+
+    async def get_timezone(self, user_id):
+        # set_timezone only returns once committed, so a user always reads back their own update
+        return await self._run_read(self._get_timezone, user_id)
+
+    def _set_timezone(self, user_id, timezone):
+        with self._transaction() as conn:
+            conn.execute(SQL_UPSERT_TIMEZONE, (user_id, timezone))
+
+    async def set_timezone(self, user_id, timezone):
+        await self._run(self._set_timezone, user_id, timezone)
@@ -0,0 +1,156 @@
+"""
+Timezone helpers for /rbtimestamp and /rbtimezone.
+
+The list of zone names is read once at startup and kept sorted, so validating
+a zone or autocompleting one is a binary search rather than a regex or a trip
+to the tz database. Users' default zones are kept in a small LRU so hot
+commands don't hit SQLite or reload tz files.
+"""
+
+import re
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from zoneinfo import ZoneInfo, available_timezones
+
+# Discord shows at most 25 autocomplete choices
+MAX_CHOICES = 25
+# Users whose default zone we remember
+USER_CACHE_SIZE = 10000
+# How long a remembered zone is trusted when other processes share the database
+SHARED_CACHE_TTL_SECONDS = 60
+
+# H, HH, H:MM or HH:MM, optionally followed by AM/PM (with or without a space or dots)
+TIMESTAMP_RE = re.compile(r"^\s*(?P<hour>\d{1,2})(?::(?P<minute>\d{2}))?\s*(?:(?P<ampm>[ap])\.?m\.?)?\s*$", re.IGNORECASE)
+
+def parse_timestamp(text):
+    """
+    Returns (hour, minute) in 24-hour time, or None if the text isn't a valid time
+    """
+    match = TIMESTAMP_RE.match(text)
+    if not match:
+        return None
+
+    hour = int(match["hour"])
+    minute = int(match["minute"]) if match["minute"] else 0
+    if minute > 59:
+        return None
+
+    ampm = match["ampm"]
+    if ampm:
+        if not 1 <= hour <= 12:
+            return None
+        # 12 AM is midnight and 12 PM is noon
+        hour %= 12
+        if ampm in "pP":
+            hour += 12
+    elif hour > 23:
+        return None
+
+    return hour, minute
+
+class TimezoneIndex:
+
+    def __init__(self, names=None):
+        names = sorted(available_timezones() if names is None else names)
+        self.names = names
+        # Lowercased copies to search on, kept parallel to the real names
+        self._folded = [name.lower() for name in names]
+        self._canonical = dict(zip(self._folded, names))
+        # Every part after the region, so "new" finds America/New_York and "buenos" finds
+        # America/Argentina/Buenos_Aires
+        segments = []
+        for name in names:
+            for segment in name.lower().split("/")[1:]:
+                segments.append((segment, name))
+        segments.sort()
+        self._segments = segments
+        self._segment_keys = [segment for segment, _ in segments]
+
+    def lookup(self, name):
+        """
+        The canonical spelling of a zone name, ignoring case, or None if it isn't a zone
+        """
+        return self._canonical.get(name.strip().lower())
+
+    def zone(self, name):
+        canonical = self.lookup(name)
+        return ZoneInfo(canonical) if canonical else None
+
+    def complete(self, prefix, limit=MAX_CHOICES):
+        """
+        Zone names starting with `prefix`, then zones with a city or sub-region
+        starting with it, up to `limit` in total
+        """
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return self.names[:limit]
+
+        results = []
+        start = bisect_left(self._folded, prefix)
+        for folded, name in zip(self._folded[start:], self.names[start:]):
+            if not folded.startswith(prefix) or len(results) >= limit:
+                break
+            results.append(name)
+
+        if len(results) < limit:
+            seen = set(results)
+            start = bisect_left(self._segment_keys, prefix)
+            for segment, name in self._segments[start:]:
+                if not segment.startswith(prefix) or len(results) >= limit:
+                    break
+                if name not in seen:
+                    seen.add(name)
+                    results.append(name)
+
+        return results
+
+class UserTimezoneCache:
+    """
+    LRU of user ID to their default ZoneInfo. Users without a default are
+    remembered too, as None.
+    """
+    _MISSING = object()
+
+    def __init__(self, index: TimezoneIndex, max_size=USER_CACHE_SIZE, ttl=None):
+        self.index = index
+        self.max_size = max_size
+        # Seconds before an entry is re-read from storage. Only needed when
+        # another process can change a user's zone behind our back.
+        self.ttl = ttl
+        # user_id -> (zone, when it was loaded)
+        self.entries: OrderedDict[int, tuple[ZoneInfo | None, float]] = OrderedDict()
+
+    def get(self, user_id):
+        """
+        The cached zone (possibly None), or _MISSING if we don't know yet
+        """
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return self._MISSING
+        zone, loaded_at = entry
+        if self.ttl is not None and time.monotonic() - loaded_at > self.ttl:
+            del self.entries[user_id]
+            return self._MISSING
+        self.entries.move_to_end(user_id)
+        return zone
+
+    def put(self, user_id, zone):
+        self.entries[user_id] = (zone, time.monotonic())
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self.entries.pop(user_id, None)
+
+    async def resolve(self, user_id, storage):
+        """
+        The user's default zone, loading it from storage on a miss
+        """
+        zone = self.get(user_id)
+        if zone is self._MISSING:
+            name = await storage.get_timezone(user_id)
+            zone = self.index.zone(name) if name else None
+            self.put(user_id, zone)
+        return zone
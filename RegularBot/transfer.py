@@ -0,0 +1,212 @@
+"""
+Bulk export and import of RegularBot's tables, used by export_data.py and
+import_data.py.
+
+Both directions stream: exports read the table through a cursor a batch at a
+time, and imports read the file a line at a time and write it with
+executemany in batches. Memory stays flat however many rows there are.
+
+Exports open the database read-only, so they're safe to run next to the bot.
+Imports keep the users / users_archive split consistent: a user is only ever
+in one of the two tables afterwards.
+"""
+
+import csv
+import json
+import sqlite3
+from RegularBot.migrations import migrate
+from RegularBot.storage import (
+    BUSY_TIMEOUT_MS, SQL_ADD_USER, SQL_RESTORE_ARCHIVED, SQL_DELETE_ARCHIVED, SQL_DELETE_USER, SQL_UPSERT_TIMEZONE,
+)
+
+CSV = "csv"
+JSONL = "jsonl"
+FORMATS = (CSV, JSONL)
+
+# Rows pulled from a cursor, or handed to executemany, at a time
+EXPORT_BATCH = 5000
+IMPORT_BATCH = 5000
+# Rows per transaction for REPLACE imports; big enough that commits don't dominate
+IMPORT_TRANSACTION_ROWS = 200000
+
+# Import modes
+REPLACE = "replace"
+MERGE = "merge"
+MODES = (REPLACE, MERGE)
+
+# Columns per table, in file order. Everything but timezone is an integer.
+TABLES = {
+    "users": ("guild_id", "user_id", "message_count", "encouraged", "congratulated", "reconciled"),
+    "users_archive": ("guild_id", "user_id", "message_count", "archived_at"),
+    "timezones": ("user_id", "timezone"),
+}
+TEXT_COLUMNS = frozenset(("timezone",))
+
+# PK order, so exports walk the primary key instead of sorting
+SQL_EXPORT = {
+    "users": "SELECT guild_id, user_id, message_count, encouraged, congratulated, reconciled FROM users ORDER BY guild_id, user_id",
+    "users_archive": "SELECT guild_id, user_id, message_count, archived_at FROM users_archive ORDER BY guild_id, user_id",
+    "timezones": "SELECT user_id, timezone FROM timezones ORDER BY user_id",
+}
+SQL_EXPORT_GUILD = {
+    "users": "SELECT guild_id, user_id, message_count, encouraged, congratulated, reconciled FROM users WHERE guild_id=? ORDER BY user_id",
+    "users_archive": "SELECT guild_id, user_id, message_count, archived_at FROM users_archive WHERE guild_id=? ORDER BY user_id",
+    # Timezones aren't per guild, so take those of everyone counted in it
+    "timezones": """
+        SELECT user_id, timezone FROM timezones t
+        WHERE EXISTS (SELECT 1 FROM users WHERE guild_id=?1 AND user_id=t.user_id)
+           OR EXISTS (SELECT 1 FROM users_archive WHERE guild_id=?1 AND user_id=t.user_id)
+        ORDER BY user_id
+    """,
+}
+
+SQL_REPLACE_USER = """
+    INSERT INTO users(guild_id, user_id, message_count, encouraged, congratulated, reconciled) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(guild_id, user_id) DO UPDATE SET
+        message_count = excluded.message_count,
+        encouraged = excluded.encouraged,
+        congratulated = excluded.congratulated,
+        reconciled = excluded.reconciled
+"""
+SQL_REPLACE_ARCHIVED = """
+    INSERT INTO users_archive(guild_id, user_id, message_count, archived_at) VALUES (?, ?, ?, ?)
+    ON CONFLICT(guild_id, user_id) DO UPDATE SET message_count = excluded.message_count, archived_at = excluded.archived_at
+"""
+
+def detect_format(path, format=None):
+    if format is not None:
+        return format
+    return JSONL if path.endswith((".jsonl", ".ndjson")) else CSV
+
+def connect(db_path, read_only=False):
+    if read_only:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        return conn
+    conn = sqlite3.connect(db_path)
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # Importing into a fresh file, or one from an older bot, needs the current schema
+    migrate(conn)
+    return conn
+
+###############################
+# Export
+###############################
+def export_table(conn: sqlite3.Connection, table, out, format=CSV, guild_id=None):
+    """
+    Streams a table to the open text file `out`. Returns the number of rows written.
+    """
+    columns = TABLES[table]
+    if guild_id is None:
+        cursor = conn.execute(SQL_EXPORT[table])
+    else:
+        cursor = conn.execute(SQL_EXPORT_GUILD[table], (guild_id,))
+
+    if format == CSV:
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        write_rows = writer.writerows
+    else:
+        def write_rows(rows):
+            out.writelines(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+
+    written = 0
+    while rows := cursor.fetchmany(EXPORT_BATCH):
+        write_rows(rows)
+        written += len(rows)
+    return written
+
+###############################
+# Import
+###############################
+def _read_rows(table, source, format):
+    """
+    Yields each row of the file as a tuple in TABLES order
+    """
+    columns = TABLES[table]
+    types = [str if column in TEXT_COLUMNS else int for column in columns]
+    if format == CSV:
+        reader = csv.reader(source)
+        header = next(reader, None)
+        if header is None:
+            return
+        missing = [column for column in columns if column not in header]
+        if missing:
+            raise ValueError(f"{table} file is missing column(s) {missing}")
+        positions = [header.index(column) for column in columns]
+        for line, row in enumerate(reader, start=2):
+            try:
+                yield tuple(kind(row[i]) for kind, i in zip(types, positions))
+            except (ValueError, IndexError) as e:
+                raise ValueError(f"line {line}: {e}")
+    else:
+        for line, text in enumerate(source, start=1):
+            if not text.strip():
+                continue
+            try:
+                record = json.loads(text)
+                yield tuple(kind(record[column]) for kind, column in zip(types, columns))
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError(f"line {line}: {e!r}")
+
+def _write_batch(conn: sqlite3.Connection, table, rows, mode):
+    if table == "timezones":
+        conn.executemany(SQL_UPSERT_TIMEZONE, rows)
+        return
+    keys = [row[:2] for row in rows]
+    if table == "users":
+        if mode == REPLACE:
+            conn.executemany(SQL_DELETE_ARCHIVED, keys)
+            conn.executemany(SQL_REPLACE_USER, rows)
+        else:
+            conn.executemany(SQL_RESTORE_ARCHIVED, keys)
+            conn.executemany(SQL_DELETE_ARCHIVED, keys)
+            conn.executemany(SQL_ADD_USER, [row[:5] for row in rows])
+    else:
+        if mode == REPLACE:
+            conn.executemany(SQL_DELETE_USER, keys)
+            conn.executemany(SQL_REPLACE_ARCHIVED, rows)
+        else:
+            # Merged counts land in users, and are archived again once reconciliation confirms the role
+            conn.executemany(SQL_RESTORE_ARCHIVED, keys)
+            conn.executemany(SQL_DELETE_ARCHIVED, keys)
+            conn.executemany(SQL_ADD_USER, [(guild_id, user_id, message_count, 1, 1) for guild_id, user_id, message_count, _ in rows])
+
+def import_table(conn: sqlite3.Connection, table, source, format=CSV, mode=REPLACE, guild_id=None):
+    """
+    Streams rows from the open text file `source` into a table. Returns the
+    number of rows imported.
+
+    REPLACE overwrites existing rows with the file's, so running it again is
+    harmless, and it commits every IMPORT_TRANSACTION_ROWS rows. MERGE adds
+    the file's message counts onto what's there, so it's one transaction:
+    either the whole file is counted or none of it is.
+    """
+    imported = 0
+    in_transaction = 0
+    batch = []
+    try:
+        for row in _read_rows(table, source, format):
+            if guild_id is not None and table != "timezones" and row[0] != guild_id:
+                continue
+            batch.append(row)
+            if len(batch) < IMPORT_BATCH:
+                continue
+            _write_batch(conn, table, batch, mode)
+            imported += len(batch)
+            in_transaction += len(batch)
+            batch = []
+            if mode == REPLACE and in_transaction >= IMPORT_TRANSACTION_ROWS:
+                conn.commit()
+                in_transaction = 0
+        if batch:
+            _write_batch(conn, table, batch, mode)
+            imported += len(batch)
+        conn.commit()
+    except BaseException:
+        # Anything a REPLACE already committed stays, and is simply overwritten if it's run again
+        conn.rollback()
+        raise
+    return imported
@@ -0,0 +1,135 @@
+"""
+Lightweight stand-ins for the discord.py objects RegularBot touches, so the
+handlers can be driven without a Discord connection. They only implement the
+attributes and methods the bot actually uses.
+"""
+
+import asyncio
+
+class FakeRole:
+    def __init__(self, id):
+        self.id = id
+
+    def __repr__(self):
+        return f"<FakeRole id={self.id}>"
+
+class FakeMember:
+    def __init__(self, id, guild, bot=False):
+        self.id = id
+        self.guild = guild
+        self.bot = bot
+        self.system = False
+        self.display_name = f"user{id}"
+        self.roles: list[FakeRole] = []
+
+    def get_role(self, role_id):
+        for role in self.roles:
+            if role.id == role_id:
+                return role
+        return None
+
+    async def add_roles(self, *roles):
+        await self.guild.world.rest_call()
+        for role in roles:
+            if role not in self.roles:
+                self.roles.append(role)
+
+class FakePartialMessage:
+    def __init__(self, channel, id):
+        self.channel = channel
+        self.id = id
+
+    async def reply(self, text):
+        await self.channel.guild.world.rest_call()
+        self.channel.guild.world.replies += 1
+
+class FakeChannel:
+    def __init__(self, id, guild):
+        self.id = id
+        self.guild = guild
+
+    def get_partial_message(self, message_id):
+        return FakePartialMessage(self, message_id)
+
+class FakeGuild:
+    def __init__(self, id, world, role_id):
+        self.id = id
+        self.world = world
+        self.name = f"guild{id}"
+        self.roles = [FakeRole(role_id)]
+        self.members: dict[int, FakeMember] = {}
+        self.text_channels: list[FakeChannel] = []
+
+    def get_role(self, role_id):
+        for role in self.roles:
+            if role.id == role_id:
+                return role
+        return None
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+    async def fetch_member(self, member_id):
+        await self.world.rest_call()
+        return self.members[member_id]
+
+class FakeMessage:
+    __slots__ = ("id", "author", "channel", "guild")
+
+    def __init__(self, id, author, channel):
+        self.id = id
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send_message(self, content=None, ephemeral=False):
+        self.interaction.sent.append(content)
+
+class FakeInteraction:
+    """
+    What slash command callbacks receive as `ctx`
+    """
+    def __init__(self, user, guild):
+        self.user = user
+        self.guild = guild
+        self.sent = []
+        self.response = FakeResponse(self)
+        self.followup = self
+
+    async def send(self, content=None, ephemeral=False):
+        self.sent.append(content)
+
+class FakeWorld:
+    """
+    Every fake guild and channel, plus a simulated REST round-trip time
+    """
+    def __init__(self, rest_latency=0.0):
+        self.rest_latency = rest_latency
+        self.guilds: dict[int, FakeGuild] = {}
+        self.channels: dict[int, FakeChannel] = {}
+        self.rest_calls = 0
+        self.replies = 0
+
+    async def rest_call(self):
+        self.rest_calls += 1
+        if self.rest_latency:
+            await asyncio.sleep(self.rest_latency)
+        else:
+            await asyncio.sleep(0)
+
+    def get_guild(self, guild_id):
+        return self.guilds.get(guild_id)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def attach(self, client):
+        """
+        Point the client's cache lookups at the fakes
+        """
+        client.get_guild = self.get_guild
+        client.get_channel = self.get_channel
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+"""
+Offline benchmark for RegularBot's hot paths.
+
+Drives RegularBotClient.on_message and the slash command handlers with fake
+Discord objects and a synthetic workload, then reports throughput, latency
+percentiles, bytes written to disk and peak memory as JSON.
+
+Run from the repository root:
+    python -m bench.run --messages 100000 --output results.json
+    python -m bench.run --compare results.json
+"""
+
+###############################
+# Imports
+###############################
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import discord
+from RegularBot.client import RegularBotClient
+from bench.fakes import FakeInteraction
+from bench.workload import Workload, WorkloadParams
+
+###############################
+# Measurement helpers
+###############################
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(latencies_ns, elapsed):
+    latencies = sorted(latencies_ns)
+    return {
+        "count": len(latencies),
+        "ops_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_us": percentile(latencies, 50) / 1000,
+        "p99_us": percentile(latencies, 99) / 1000,
+        "max_us": (latencies[-1] / 1000) if latencies else 0.0,
+    }
+
+def disk_bytes_written():
+    """
+    Bytes this process has caused to be written to storage (Linux only)
+    """
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def db_file_bytes(db_path):
+    return sum(os.path.getsize(p) for p in (db_path, db_path + "-wal") if os.path.exists(p))
+
+def peak_rss_kib():
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+###############################
+# Benchmarks
+###############################
+async def timed_calls(calls, concurrency):
+    """
+    Runs zero-argument coroutine functions `concurrency` at a time, returning
+    (per-call latencies in ns, wall time in seconds)
+    """
+    latencies = []
+
+    async def timed(call):
+        start = time.perf_counter_ns()
+        await call()
+        latencies.append(time.perf_counter_ns() - start)
+
+    wall_start = time.perf_counter()
+    batch = []
+    for call in calls:
+        batch.append(timed(call))
+        if len(batch) >= concurrency:
+            await asyncio.gather(*batch)
+            batch = []
+    if batch:
+        await asyncio.gather(*batch)
+    return latencies, time.perf_counter() - wall_start
+
+async def drain_dispatch(client, timeout=60):
+    stats = client.dispatch_queue.stats
+    deadline = time.monotonic() + timeout
+    while stats.completed + stats.failed < stats.enqueued and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+def command_callback(client, name, guild=None):
+    command = client.command_tree.get_command(name, guild=guild)
+    return command.callback
+
+async def run_benchmarks(workload: Workload, args):
+    client = RegularBotClient(discord.Intents.default())
+    workload.world.attach(client)
+    await client.storage.open()
+    client.dispatch_queue.start(client)
+    db_path = client.storage.db_path
+
+    results = {}
+    io_start = disk_bytes_written()
+    db_start = db_file_bytes(db_path)
+
+    # on_message, including the flushes and REST dispatch it causes
+    calls = (lambda m=m: client.on_message(m) for m in workload.messages())
+    latencies, elapsed = await timed_calls(calls, args.concurrency)
+    await drain_dispatch(client)
+    await client.flush_counters()
+    results["on_message"] = summarize(latencies, elapsed)
+    results["on_message"]["replies"] = workload.world.replies
+    results["on_message"]["rest_calls"] = workload.world.rest_calls
+
+    # Slash commands
+    howfar = command_callback(client, "rbhowfar")
+    timezone = command_callback(client, "rbtimezone")
+    timestamp = command_callback(client, "rbtimestamp")
+    members = list(workload.members(args.command_calls))
+
+    latencies, elapsed = await timed_calls((lambda m=m: howfar(FakeInteraction(m, m.guild)) for m in members), args.concurrency)
+    results["rbhowfar"] = summarize(latencies, elapsed)
+    latencies, elapsed = await timed_calls((lambda m=m: timezone(FakeInteraction(m, m.guild), "America/New_York") for m in members), args.concurrency)
+    results["rbtimezone"] = summarize(latencies, elapsed)
+    latencies, elapsed = await timed_calls((lambda m=m: timestamp(FakeInteraction(m, m.guild), "3:30 PM") for m in members), args.concurrency)
+    results["rbtimestamp"] = summarize(latencies, elapsed)
+
+    await client.close()
+
+    io_end = disk_bytes_written()
+    results["storage"] = {
+        "disk_bytes_written": (io_end - io_start) if io_start is not None and io_end is not None else None,
+        "db_file_growth_bytes": db_file_bytes(db_path) - db_start,
+    }
+    results["memory"] = {"peak_rss_kib": peak_rss_kib()}
+    return results
+
+###############################
+# Reporting
+###############################
+def compare(current, previous):
+    """
+    Prints each metric next to the previous run's value
+    """
+    for section, metrics in current["results"].items():
+        old_metrics = previous.get("results", {}).get(section, {})
+        for name, value in metrics.items():
+            old = old_metrics.get(name)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+                continue
+            change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"{section}.{name}: {old} -> {value} ({change})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for RegularBot")
+    parser.add_argument("--guilds", type=int, default=10)
+    parser.add_argument("--users", type=int, default=1000, help="users per guild")
+    parser.add_argument("--channels", type=int, default=5, help="channels per guild")
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent for user activity")
+    parser.add_argument("--threshold", type=int, default=200, help="messages needed to become a Regular")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--count-limit", help="per-user count limit as MESSAGES/SECONDS, e.g. 5/60")
+    parser.add_argument("--concurrency", type=int, default=32, help="handler calls in flight at once")
+    parser.add_argument("--command-calls", type=int, default=2000, help="calls per slash command")
+    parser.add_argument("--rest-latency", type=float, default=0.0, help="simulated REST round trip in seconds")
+    parser.add_argument("--output", help="write the results to this JSON file as well as stdout")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    args = parser.parse_args()
+
+    params = WorkloadParams(
+        guilds=args.guilds,
+        users_per_guild=args.users,
+        channels_per_guild=args.channels,
+        messages=args.messages,
+        skew=args.skew,
+        threshold=args.threshold,
+        seed=args.seed,
+        count_limit=tuple(float(x) if i else int(x) for i, x in enumerate(args.count_limit.split("/"))) if args.count_limit else None,
+    )
+    workload = Workload(params, rest_latency=args.rest_latency)
+
+    # The client reads config/config.json and writes db/ relative to the working directory
+    workdir = tempfile.mkdtemp(prefix="regularbot-bench-")
+    os.makedirs(os.path.join(workdir, "config"))
+    with open(os.path.join(workdir, "config", "config.json"), "w") as f:
+        json.dump(workload.config(), f)
+    os.chdir(workdir)
+
+    results = asyncio.run(run_benchmarks(workload, args))
+    report = {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "params": dict(params.as_dict(), concurrency=args.concurrency, command_calls=args.command_calls, rest_latency=args.rest_latency),
+        "results": results,
+    }
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(os.path.join(REPO_ROOT, args.output) if not os.path.isabs(args.output) else args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(os.path.join(REPO_ROOT, args.compare) if not os.path.isabs(args.compare) else args.compare) as f:
+            compare(report, json.load(f))
+
+if __name__ == "__main__":
+    main()
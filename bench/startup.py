@@ -0,0 +1,151 @@
+#!/usr/bin/python
+"""
+Startup cost of each member cache mode.
+
+Builds RegularBotClient in each mode and feeds its connection state the same
+GUILD_CREATE payloads Discord would send. In "full" mode every member is then
+loaded the way chunking loads them, and in "lazy" mode only the recently
+active members are, the way the message handler would see them. Each mode
+runs in its own process so the memory numbers don't bleed into each other.
+
+This measures the CPU time and memory of holding the members. It doesn't
+include the gateway round trips chunking waits on, which add to the full
+mode's startup time in production (see chunk_requests in the output).
+
+Run from the repository root:
+    python -m bench.startup --guilds 5 --members 100000
+"""
+
+###############################
+# Imports
+###############################
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import discord
+from RegularBot.client import RegularBotClient
+from bench.run import git_revision
+from bench.workload import Workload, WorkloadParams, USER_ID_BASE
+
+# Members Discord sends per GUILD_MEMBERS_CHUNK event
+CHUNK_SIZE = 1000
+
+###############################
+# Payloads
+###############################
+def guild_payload(guild_id, role_id, member_count):
+    return {
+        "id": str(guild_id),
+        "name": f"guild{guild_id}",
+        "owner_id": str(USER_ID_BASE),
+        "large": member_count > 250,
+        "member_count": member_count,
+        "roles": [
+            {"id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0, "color": 0, "hoist": False, "managed": False, "mentionable": False},
+            {"id": str(role_id), "name": "Regular", "permissions": "0", "position": 1, "color": 0, "hoist": False, "managed": False, "mentionable": False},
+        ],
+        # Large guilds only come with a handful of members, which is why they need chunking
+        "members": [],
+        "channels": [],
+    }
+
+def member_payload(user_id, role_ids=()):
+    return {
+        "user": {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "global_name": None, "avatar": None},
+        "roles": [str(r) for r in role_ids],
+        "joined_at": "2024-01-01T00:00:00+00:00",
+        "deaf": False,
+        "mute": False,
+        "flags": 0,
+    }
+
+def rss_kib():
+    # Current, not peak, resident set size (Linux only)
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+###############################
+# Measurement
+###############################
+def measure(mode, args):
+    """
+    Runs in the child process: loads one mode and returns its numbers
+    """
+    params = WorkloadParams(guilds=args.guilds, users_per_guild=1, channels_per_guild=1)
+    workload = Workload(params)
+    config = workload.config()
+    config["member_cache"] = {"mode": mode, "max_members": args.recent}
+
+    workdir = tempfile.mkdtemp(prefix="regularbot-startup-")
+    os.makedirs(os.path.join(workdir, "config"))
+    with open(os.path.join(workdir, "config", "config.json"), "w") as f:
+        json.dump(config, f)
+    os.chdir(workdir)
+
+    client = RegularBotClient(discord.Intents.default())
+    state = client._connection
+    rss_start = rss_kib()
+    start = time.perf_counter()
+
+    chunk_requests = 0
+    for guild in workload.guilds:
+        g = state._add_guild_from_data(guild_payload(guild.id, guild.roles[0].id, args.members))
+        if state._guild_needs_chunking(g):
+            for first in range(0, args.members, CHUNK_SIZE):
+                chunk_requests += 1
+                for user_id in range(USER_ID_BASE + first, USER_ID_BASE + min(first + CHUNK_SIZE, args.members)):
+                    g._add_member(discord.Member(data=member_payload(user_id), guild=g, state=state))
+        else:
+            # Members come in with the messages they send instead
+            for user_id in range(USER_ID_BASE, USER_ID_BASE + min(args.recent, args.members)):
+                client.members.remember(discord.Member(data=member_payload(user_id), guild=g, state=state))
+
+    elapsed = time.perf_counter() - start
+    return {
+        "startup_seconds": elapsed,
+        "rss_growth_kib": rss_kib() - rss_start,
+        "cached_members": sum(len(g._members) for g in state._guilds.values()) + len(client.members.entries),
+        "chunk_requests": chunk_requests,
+        "members_intent": client.intents.members,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time and memory for each member cache mode")
+    parser.add_argument("--guilds", type=int, default=5)
+    parser.add_argument("--members", type=int, default=50000, help="members per guild")
+    parser.add_argument("--recent", type=int, default=10000, help="recently active members kept in lazy mode")
+    parser.add_argument("--modes", default="full,lazy", help="comma separated member cache modes to measure")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child, args)))
+        return
+
+    results = {}
+    for mode in args.modes.split(","):
+        out = subprocess.check_output(
+            [sys.executable, "-m", "bench.startup", "--child", mode,
+             "--guilds", str(args.guilds), "--members", str(args.members), "--recent", str(args.recent)],
+            cwd=REPO_ROOT, text=True,
+        )
+        results[mode] = json.loads(out.strip().splitlines()[-1])
+
+    report = {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "params": {"guilds": args.guilds, "members": args.members, "recent": args.recent},
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Synthetic workload generator for the benchmarks.
+
+Builds a fake world of guilds, channels and members plus a matching config,
+then yields messages with Zipf-skewed user activity, so a few users do most
+of the talking and some of them cross the Regular threshold mid-run.
+"""
+
+import bisect
+import itertools
+import random
+from bench.fakes import FakeWorld, FakeGuild, FakeChannel, FakeMember, FakeMessage
+
+# IDs are offset so guilds, channels, roles and users never collide
+GUILD_ID_BASE = 1_000_000
+CHANNEL_ID_BASE = 2_000_000
+ROLE_ID_BASE = 3_000_000
+USER_ID_BASE = 4_000_000
+DEBUG_GUILD_ID = 999
+DEBUG_CHANNEL_ID = 998
+MAINTAINER_ID = 997
+
+class WorkloadParams:
+    def __init__(self, guilds=10, users_per_guild=1000, channels_per_guild=5, messages=50000,
+                 skew=1.1, threshold=200, bot_fraction=0.02, seed=1234, count_limit=None):
+        self.guilds = guilds
+        self.users_per_guild = users_per_guild
+        self.channels_per_guild = channels_per_guild
+        self.messages = messages
+        # Zipf exponent for user activity; 0 means every user is equally chatty
+        self.skew = skew
+        self.threshold = threshold
+        self.bot_fraction = bot_fraction
+        self.seed = seed
+        # (messages, seconds) per user, or None to count everything
+        self.count_limit = count_limit
+
+    def as_dict(self):
+        return dict(vars(self))
+
+class Workload:
+
+    def __init__(self, params: WorkloadParams, rest_latency=0.0):
+        self.params = params
+        self.world = FakeWorld(rest_latency)
+        self.guilds: list[FakeGuild] = []
+        self._message_ids = itertools.count(5_000_000)
+
+        for g in range(params.guilds):
+            guild_id = GUILD_ID_BASE + g
+            guild = FakeGuild(guild_id, self.world, ROLE_ID_BASE + g)
+            for c in range(params.channels_per_guild):
+                channel = FakeChannel(CHANNEL_ID_BASE + g * params.channels_per_guild + c, guild)
+                guild.text_channels.append(channel)
+                self.world.channels[channel.id] = channel
+            for u in range(params.users_per_guild):
+                # Users are shared across guilds, like real people in several servers.
+                # The least active ones are bots, so the chatty users can actually become Regulars.
+                user_id = USER_ID_BASE + u
+                guild.members[user_id] = FakeMember(user_id, guild, bot=(u >= params.users_per_guild * (1 - params.bot_fraction)))
+            self.world.guilds[guild_id] = guild
+            self.guilds.append(guild)
+
+        weights = [1.0 / ((rank + 1) ** params.skew) for rank in range(params.users_per_guild)]
+        self._user_cdf = list(itertools.accumulate(weights))
+
+    def config(self, sql_db="bench.db"):
+        config = {
+            "sql_db": sql_db,
+            "process_name": "regular_bot_bench",
+            "presences": {"Benchmarks": "playing"},
+            "debug": {"enabled": False, "guild_id": str(DEBUG_GUILD_ID), "channel_id": str(DEBUG_CHANNEL_ID)},
+            "maintainers": {str(MAINTAINER_ID): {"name": "bench", "notify_on_exception": False}},
+            "guilds": {
+                str(guild.id): {
+                    "name": guild.name,
+                    "regular": {
+                        "role_id": str(guild.roles[0].id),
+                        "message_threshold": self.params.threshold,
+                        "encouragement": "Nice work {user}, you've already sent {message_count} messages. You're halfway to a **Regular** role!",
+                        "congrats": "Wow {user}, you've sent {message_count} messages already? You're clearly a **Regular** around here!",
+                        "ignore_channels": [str(guild.text_channels[-1].id)],
+                    },
+                }
+                for guild in self.guilds
+            },
+        }
+        if self.params.count_limit:
+            messages, seconds = self.params.count_limit
+            for guild_config in config["guilds"].values():
+                guild_config["regular"]["count_limit"] = {"messages": messages, "seconds": seconds}
+        return config
+
+    def _pick_user(self, rng: random.Random):
+        return bisect.bisect_left(self._user_cdf, rng.random() * self._user_cdf[-1])
+
+    def messages(self):
+        """
+        Yields params.messages fake messages. Deterministic for a given seed.
+        """
+        rng = random.Random(self.params.seed)
+        for _ in range(self.params.messages):
+            guild = self.guilds[rng.randrange(len(self.guilds))]
+            channel = guild.text_channels[rng.randrange(len(guild.text_channels))]
+            author = guild.members[USER_ID_BASE + self._pick_user(rng)]
+            yield FakeMessage(next(self._message_ids), author, channel)
+
+    def members(self, count, seed=None):
+        """
+        A random sample of members, for driving slash commands
+        """
+        rng = random.Random(self.params.seed if seed is None else seed)
+        for _ in range(count):
+            guild = self.guilds[rng.randrange(len(self.guilds))]
+            yield guild.members[USER_ID_BASE + self._pick_user(rng)]
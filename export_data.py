@@ -0,0 +1,47 @@
+#!/usr/bin/python
+"""
+Export RegularBot's data as CSV or JSON lines, streamed a batch at a time.
+
+    python export_data.py users -o users.csv
+    python export_data.py users --guild 1234 --format jsonl > users.jsonl
+    python export_data.py timezones -o timezones.jsonl
+
+Opens the database read-only, so it's safe to run while the bot is up.
+"""
+
+###############################
+# Imports
+###############################
+import argparse
+import sys
+from RegularBot.config import RegularBotConfig, CONFIG_PATH
+from RegularBot.transfer import TABLES, FORMATS, connect, detect_format, export_table
+
+###############################
+# Main
+###############################
+def main():
+    parser = argparse.ArgumentParser(description="Export a RegularBot table as CSV or JSON lines")
+    parser.add_argument("table", choices=TABLES)
+    parser.add_argument("-o", "--output", default="-", help="file to write, or - for stdout")
+    parser.add_argument("--format", choices=FORMATS, help="defaults to the output file's extension, or csv")
+    parser.add_argument("--guild", type=int, help="only this guild's rows (for timezones, those of users counted in it)")
+    parser.add_argument("--db", help="database file, instead of the one in the config")
+    args = parser.parse_args()
+
+    db_path = args.db or "db/" + RegularBotConfig(CONFIG_PATH)['sql_db']
+    format = detect_format(args.output, args.format)
+    conn = connect(db_path, read_only=True)
+    try:
+        if args.output == "-":
+            written = export_table(conn, args.table, sys.stdout, format, args.guild)
+        else:
+            with open(args.output, "w", newline="") as out:
+                written = export_table(conn, args.table, out, format, args.guild)
+    finally:
+        conn.close()
+    # stdout may be the export itself
+    print(f"exported {written} {args.table} rows", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+"""
+Import RegularBot data exported by export_data.py, streamed a batch at a time.
+
+    python import_data.py users users.csv
+    python import_data.py users other_bot_users.jsonl --mode merge
+    python import_data.py users - --format jsonl --guild 1234 < users.jsonl
+
+replace (the default) overwrites rows that are already there; merge adds the
+file's message counts onto them. Stop the bot first: it keeps counts in
+memory and would write its own totals back over a replace.
+"""
+
+###############################
+# Imports
+###############################
+import argparse
+import sys
+from RegularBot.config import RegularBotConfig, CONFIG_PATH
+from RegularBot.transfer import TABLES, FORMATS, MODES, REPLACE, connect, detect_format, import_table
+
+###############################
+# Main
+###############################
+def main():
+    parser = argparse.ArgumentParser(description="Import a RegularBot table from CSV or JSON lines")
+    parser.add_argument("table", choices=TABLES)
+    parser.add_argument("input", help="file to read, or - for stdin")
+    parser.add_argument("--format", choices=FORMATS, help="defaults to the input file's extension, or csv")
+    parser.add_argument("--mode", choices=MODES, default=REPLACE)
+    parser.add_argument("--guild", type=int, help="only import this guild's rows")
+    parser.add_argument("--db", help="database file, instead of the one in the config")
+    args = parser.parse_args()
+
+    db_path = args.db or "db/" + RegularBotConfig(CONFIG_PATH)['sql_db']
+    format = detect_format(args.input, args.format)
+    conn = connect(db_path)
+    try:
+        if args.input == "-":
+            imported = import_table(conn, args.table, sys.stdin, format, args.mode, args.guild)
+        else:
+            with open(args.input, newline="") as source:
+                imported = import_table(conn, args.table, source, format, args.mode, args.guild)
+    except ValueError as e:
+        sys.exit(f"import failed: {e}")
+    finally:
+        conn.close()
+    print(f"imported {imported} {args.table} rows ({args.mode})")
+
+if __name__ == "__main__":
+    main()
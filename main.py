@@ -4,12 +4,15 @@
 # Imports
 ###############################
 import discord 
+import asyncio
 import traceback
 import os
 import signal
-from RegularBot.config import RegularBotConfig
-from RegularBot.client import RegularBotClient
-from RegularBot.safe_client import RegularBotSafeClient
+import multiprocessing
+import random
+from RegularBot.config import RegularBotConfig, CONFIG_PATH
+from RegularBot.client import RegularBotClient, RegularBotShardedClient
+from RegularBot.outbox import format_crash, deliver_over_rest
 from dotenv import load_dotenv
 import socket
 import time
@@ -17,7 +20,14 @@ import time
 ###############################
 # Top level constants
 ###############################
-CRASH_REBOOT_ATTEMPTS = 3
+# Delay before each restart, doubling per crash in a row up to the max, with jitter.
+# Anything but a fatal error is retried for as long as it takes, e.g. a Discord outage.
+RESTART_BASE_SECONDS = 2
+RESTART_MAX_SECONDS = 300
+# A client that stayed up this long wasn't crash looping, so the count starts over
+HEALTHY_SECONDS = 600
+# Restarting won't fix these
+FATAL_ERRORS = (discord.LoginFailure, discord.PrivilegedIntentsRequired)
 ENV_FILE = ".env"
 
 ###############################
@@ -31,21 +41,45 @@ def interrupt_handler(signum, frame):
 # Run
 ###############################
 class RegularBotWrapper:
-    def __init__(self):
+    def __init__(self, sharded=False, shard_ids=None, shard_count=None, worker=0):
         # variable that says it's worth trying to reconnect to Discord
         # used by the main retry loop
-        # only fatal errors will change this value
+        # only fatal errors, or a SIGTERM, will change this value
         self.willing = True
 
         # Intents are basically bot features we can disable/enable.
-        # Default is fine.
+        # Default is fine. The members intent is set by the client, based on
+        # the member_cache mode in the config.
         self.intents = discord.Intents.default()
         self.intents.guild_messages = True
         self.intents.message_content = True
-        self.intents.members = True
+
+        # Which shards this process runs; shard_ids of None means all of them
+        self.sharded = sharded
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.worker = worker
+        self.key = None
+        # The client.close() started by a SIGTERM
+        self.closing = None
 
         # Build the client & grab config
-        self.client = RegularBotClient(self.intents)
+        self.client = self.build_client()
+        self.config = self.client.config
+
+    def build_client(self, previous=None):
+        if self.sharded:
+            return RegularBotShardedClient(self.intents, worker=self.worker, shard_ids=self.shard_ids, shard_count=self.shard_count, previous=previous)
+        return RegularBotClient(self.intents, previous=previous)
+
+    def restart(self, crashed_at):
+        """
+        Replace the crashed client with a fresh one. A client can't be run
+        twice (its event loop and tasks are gone), but its caches and queued
+        work can be handed to the new one.
+        """
+        self.client = self.build_client(previous=self.client)
+        self.client.restart_started = crashed_at
         self.config = self.client.config
 
     def load_env(self):
@@ -54,23 +88,49 @@ class RegularBotWrapper:
         self.env = load_dotenv(env_path)
 
     def run(self):
-        # Load env
-        self.load_env()
+        if self.key is None:
+            # Load env
+            self.load_env()
 
-        # Get auth key
-        key = os.getenv("REGBOT_DISCORD_OAUTH_TOKEN")
-        if not key:
-            raise ValueError("REGBOT_DISCORD_OAUTH_TOKEN not found in env")
-        
-        self.client.run(key)    
+            # Get auth key
+            self.key = os.getenv("REGBOT_DISCORD_OAUTH_TOKEN")
+            if not self.key:
+                raise ValueError("REGBOT_DISCORD_OAUTH_TOKEN not found in env")
+
+        async def runner():
+            # Closes the client however start() ends, which flushes counts and
+            # parks the dispatch queue for the next client.
+            # reconnect=True: dropped connections are resumed (or re-identified if
+            # Discord won't resume the session) inside start(), without ever
+            # getting here.
+            # systemd and Docker stop us with SIGTERM, which by default would
+            # lose every count not flushed yet
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.stop)
+            async with self.client:
+                await self.client.start(self.key, reconnect=True)
 
-    def send_crash_notification(self, tb):
+        asyncio.run(runner())
+
+    def stop(self):
         """
-        Log in to the bot account with a lightweight client and send a message to bot maintainer(s)
-        indicating there was an error.
-        Get the maintainers from a list in configs and PM them? Or just ping a role in a private channel?
+        Shuts down for good, closing the client like any other shutdown so
+        counts are flushed. start() returns once it's closed.
         """
-        print("sending crash notif")
+        print("Got signal SIGTERM, shutting down")
+        self.willing = False
+        if self.closing is None:
+            self.closing = asyncio.create_task(self.client.close())
+
+    def send_crash_notification(self, tb, rebooting):
+        """
+        Queue a crash notice for the bot maintainer(s) in the on-disk outbox.
+        If we're about to reboot, the new client delivers it as soon as it's
+        logged in. Otherwise, deliver it now over REST, without a gateway login.
+        """
+        print("queueing crash notif")
+        self.client.outbox.put(format_crash(tb))
+        if rebooting:
+            return
 
         # Load environment
         self.load_env()
@@ -80,49 +140,146 @@ class RegularBotWrapper:
         if not key:
             raise ValueError("REGBOT_DISCORD_OAUTH_TOKEN not found in env")
 
-        temp_client = RegularBotSafeClient(self.intents, self.config, tb)
-        temp_client.run(key)
+        print("sending crash notif")
+        asyncio.run(deliver_over_rest(key, self.config.notify_ids, self.client.outbox))
 
     def get_lock(self):
         # Binding the lock reference to the function itself so it doesn't get
         # garbage collected so long as the wrapper exists
-        self._lock_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._lock_socket = get_lock(lock_name(self.config['process_name'], self.shard_ids, self.shard_count))
+        return self._lock_socket is not None
+
+###############################
+# Locks
+###############################
+def lock_name(process_name, shard_ids=None, shard_count=None):
+    """
+    Each set of shards gets its own lock, so two processes can never run the same shard
+    """
+    if shard_ids is None:
+        return process_name
+    return f"{process_name}-shards-{shard_ids[0]}-{shard_ids[-1]}-of-{shard_count}"
 
-        process_name = self.config['process_name']
+def get_lock(name):
+    """
+    Returns the bound socket holding the lock, or None if another process has it.
+    Keep a reference to the socket for as long as the lock should be held.
+    """
+    lock_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        # The null byte (\0) means the socket is created 
+        # in the abstract namespace instead of being created 
+        # on the file system itself.
+        # Works only in Linux
+        lock_socket.bind('\0' + name)
+        return lock_socket
+    except socket.error:
+        lock_socket.close()
+        return None
 
-        try:
-            # The null byte (\0) means the socket is created 
-            # in the abstract namespace instead of being created 
-            # on the file system itself.
-            # Works only in Linux
-            self._lock_socket.bind('\0' + process_name)
-            return True
-        except socket.error:
-            return False
+###############################
+# Sharding
+###############################
+def shard_ranges(shard_count, processes):
+    """
+    Splits shards 0..shard_count-1 into `processes` contiguous ranges, as even as possible
+    """
+    per_process, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for i in range(processes):
+        end = start + per_process + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
 
+def launch(config: RegularBotConfig):
+    """
+    Runs one bot process per shard range and waits for them all. Each process
+    has its own gateway connections, event loop and caches, and they share the
+    SQLite database (see RegularBot/storage.py for why that's safe).
+    """
+    ranges = shard_ranges(config.shard_count, config.shard_processes)
+    processes = []
+    for worker, shard_ids in enumerate(ranges):
+        process = multiprocessing.Process(
+            target=run_bot,
+            kwargs={"sharded": True, "shard_ids": shard_ids, "shard_count": config.shard_count, "worker": worker},
+            name=f"{config['process_name']}-{worker}",
+        )
+        process.start()
+        print(f"started worker {worker} (pid {process.pid}) for shards {shard_ids[0]}-{shard_ids[-1]} of {config.shard_count}")
+        processes.append(process)
 
-if __name__ == "__main__":\
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+###############################
+# Main
+###############################
+def run_bot(sharded=False, shard_ids=None, shard_count=None, worker=0):
     # Create bot
-    w = RegularBotWrapper()
+    w = RegularBotWrapper(sharded, shard_ids, shard_count, worker)
     
-    # Check if the bot is already running in another process, and if so, exit
+    # Check if the bot (or this set of shards) is already running in another process, and if so, exit
     if not w.get_lock():
         exit(0)
     
     signal.signal(signal.SIGINT, interrupt_handler)
-    
-    reboots = 0
-    while reboots <= CRASH_REBOOT_ATTEMPTS and w.willing:
-        print(f"reboot attempts: {reboots}")
-        reboots += 1
-        
+    # Client.run would do this, but it'd add another log handler on every restart
+    discord.utils.setup_logging()
+
+    crashes = 0
+    # When the bot first went down, while it's being restarted
+    down_since = None
+    while w.willing:
+        started = time.perf_counter()
         try:
+            if down_since is not None:
+                # Building the new client reloads the config, which can fail like anything else
+                w.restart(down_since)
+                down_since = None
             w.run()
+            # start() only returns once the client was closed on purpose
+            return
 
         except Exception as e:
+            crashed_at = time.perf_counter()
+            if down_since is None:
+                down_since = crashed_at
+            if crashed_at - started >= HEALTHY_SECONDS:
+                crashes = 0
+            crashes += 1
             traceback_fmt = traceback.format_exception(e)
 
-            if reboots > CRASH_REBOOT_ATTEMPTS:
-                traceback_fmt.append(f"\nFurthermore, the maximum number of reboot attempts ({CRASH_REBOOT_ATTEMPTS}) has been reached, and the bot will not attempt to reboot again")
+            if isinstance(e, FATAL_ERRORS):
+                w.willing = False
+                traceback_fmt.append("\nThis error won't go away by rebooting, so the bot will not attempt to reboot")
+
+            w.send_crash_notification(traceback_fmt, rebooting=w.willing)
+            if not w.willing:
+                return
+
+            delay = min(RESTART_MAX_SECONDS, RESTART_BASE_SECONDS * 2 ** (crashes - 1)) * random.uniform(0.5, 1.0)
+            print(f"crash {crashes} in a row, restarting in {delay:.1f}s")
+            time.sleep(delay)
+
+if __name__ == "__main__":
+    config = RegularBotConfig(CONFIG_PATH)
 
-            w.send_crash_notification(traceback_fmt)
+    if config.shard_processes > 1:
+        # Held for as long as the launcher runs, so only one launcher starts the workers
+        launcher_lock = get_lock(config['process_name'])
+        if launcher_lock is None:
+            exit(0)
+        signal.signal(signal.SIGINT, interrupt_handler)
+        # Exiting terminates the workers, which then shut down cleanly on their own
+        signal.signal(signal.SIGTERM, interrupt_handler)
+        launch(config)
+    else:
+        run_bot(sharded=config.sharding_enabled, shard_count=config.shard_count)